@@ -0,0 +1,59 @@
+''' Fixtures shared by the unit tests in ``src/dent/*.pt``.
+
+    Each ``*.pt`` file builds its own ``fake_docker`` (the Docker state its
+    code under test sees) on one of these: `docker_recorder` for code that
+    only changes Docker state through `dent.docker.drcall()`, and
+    `docker_command` for code that runs the ``docker`` command itself.
+'''
+
+from    collections.abc  import Callable, Iterator
+import  os, pytest
+
+from    dent  import docker, engine
+
+@pytest.fixture
+def docker_recorder(tmp_path, monkeypatch) -> dict:
+    ''' Replace `docker.drcall()` with a recorder: each command (less the
+        ``docker`` itself) is appended to the returned dict's ``commands``
+        and its stdin kept in ``input``. The command succeeds, unless the
+        dict has an ``effect``, a function which is called with the command
+        (e.g., to update the test's fake state) and returns the exit code.
+        `docker.docker_setup()` does nothing, and ``$XDG_STATE_HOME`` is
+        ``state`` under `tmp_path`.
+    '''
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path/'state'))
+    d:dict = { 'commands': [], 'input': None, 'effect': None }
+    def drcall(conf, command, input=None, **kwargs):
+        d['commands'].append(command[1:])
+        d['input'] = input
+        return 0 if d['effect'] is None else d['effect'](command)
+    monkeypatch.setattr(docker, 'drcall', drcall)
+    monkeypatch.setattr(docker, 'docker_setup', lambda: None)
+    return d
+
+@pytest.fixture
+def docker_command(tmp_path, monkeypatch
+        ) -> Iterator[Callable[[str],Callable[[],list[str]]]]:
+    ''' Return a function that, given the body `cases` of a shell ``case
+        "$*" in ... esac``, puts in the path a ``docker`` command that logs
+        its arguments and then runs those cases; it returns a function
+        returning the logged arguments of each run so far. The daemon's
+        socket is never used, ``$XDG_STATE_HOME`` is ``state`` under
+        `tmp_path`, and how we reached the daemon is forgotten afterwards.
+    '''
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path/'state'))
+    monkeypatch.setattr(engine, 'socket_path', lambda environ=None: None)
+    bindir = tmp_path/'bin'; bindir.mkdir()
+    log = tmp_path/'docker.log'
+    monkeypatch.setenv('PATH', f'{bindir}:{os.environ["PATH"]}')
+
+    def install(cases:str) -> Callable[[],list[str]]:
+        script = bindir/'docker'
+        script.write_text('#!/bin/sh\n'
+            f'echo "$*" >> {log}\n'
+            f'case "$*" in\n{cases}esac\n')
+        script.chmod(0o755)
+        return lambda: log.read_text().splitlines() if log.exists() else []
+
+    yield install
+    docker.reset_access()
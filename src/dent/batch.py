@@ -0,0 +1,311 @@
+''' dent.batch - run a command in many containers, or build many images, at once
+
+    In the ``-M`` mode the containers are each readied (created and/or
+    started as necessary) and entered just as a single ``dent NAME
+    COMMAND`` would, but with several at a time in separate threads, no
+    terminal, and the output of each command copied to ours with each line
+    prefixed by the container name.
+
+    In the ``--build`` mode images are built (or, with ``--refresh``, have
+    their packages upgraded) for several base images at a time, each
+    logging to its own file while we display their status.
+'''
+
+from    collections.abc  import Callable, Iterable
+from    concurrent.futures  import ThreadPoolExecutor
+from    dataclasses  import asdict, dataclass, replace
+from    datetime  import datetime
+from    fnmatch  import fnmatchcase
+from    pathlib  import Path
+from    subprocess  import DEVNULL, PIPE, Popen
+from    threading  import Lock, Thread
+from    typing  import IO, TextIO
+import  json, os, sys, time
+
+from    dent  import container, docker, image, trace
+from    dent.configure  import BuildImages, Config, RunBatch
+from    dent.image  import Refresh
+from    dent.util  import die, host_state, qprint
+
+@dataclass(frozen=True)
+class Result:
+    name    : str
+    status  : int|None      # exit status of the command, None if not run
+    seconds : float
+
+    @property
+    def ok(self) -> bool:  return self.status == 0
+
+def run_batch(batch:RunBatch) -> int:
+    ''' Run the batch, returning 0 if the command succeeded in all
+        containers, or 1 otherwise.
+    '''
+    conf = batch.conf
+    docker.docker_setup()
+    names = expand_names(batch.names, docker.docker_container_names)
+    if not names:
+        die('No containers match {}'.format(' '.join(batch.names)))
+    output = Output(max(map(len, names)))
+    def run(name:str) -> Result:
+        return run_one(replace(conf, CONTAINER_NAME=name), output)
+    with ThreadPoolExecutor(max_workers=batch.jobs) as pool:
+        results = list(pool.map(run, names))
+    print_summary(conf, results)
+    return 0 if all(r.ok for r in results) else 1
+
+def expand_names(patterns:Iterable[str], all_names:Callable[[],list[str]]
+        ) -> list[str]:
+    ''' Return the (container or base image) names given by `patterns`, in
+        order and without duplicates. A pattern containing glob characters
+        is replaced by the existing names (from `all_names()`) it matches;
+        others are taken as-is, whether or not they exist.
+    '''
+    names:dict[str,None] = {}       # an ordered set
+    existing:list[str]|None = None
+    for pattern in patterns:
+        if not any(c in pattern for c in '*?['):
+            names[pattern] = None
+            continue
+        if existing is None:  existing = sorted(all_names())
+        names.update((n, None) for n in existing if fnmatchcase(n, pattern))
+    return list(names)
+
+def run_one(conf:Config, output:'Output') -> Result:
+    ''' Ready the container `conf.CONTAINER_NAME` and run the command in
+        it. Failures to create or start the container have already been
+        reported (by `die()`) when the `Result` status is `None`.
+    '''
+    t0 = time.monotonic()
+    status:int|None = None
+    try:
+        c = docker.docker_inspect('container', conf.CONTAINER_NAME)
+        #   -B, -i, etc. are for the containers we need to create. These
+        #   are created concurrently; the image lock (see `dent.locks`)
+        #   keeps those needing the same image from all building it.
+        if c is None:
+            has_share = container.ready_container(conf, None)
+        else:
+            has_share = container.ready_container(conf, c, new_only_opts=True)
+        command, env = container.entry_command(conf, has_share, tty=False)
+        if conf.dry_run:
+            output.message(' '.join(command))
+            status = 0
+        else:
+            #   A batch entry is as much a use as any other, for the
+            #   idle time of `--status` and `--stop-idle`.
+            if has_share:  container.record_entry(conf)
+            status = output.run(conf.CONTAINER_NAME, command, env)
+    except SystemExit:
+        pass
+    return Result(conf.CONTAINER_NAME, status, time.monotonic() - t0)
+
+class Output:
+    ''' Copies the output of commands to our stdout and stderr, each line
+        prefixed with the name of the container (padded to `width`), and
+        a line at a time so that lines from different commands are never
+        mixed.
+    '''
+
+    def __init__(self, width:int):
+        self.width = width
+        self.lock = Lock()
+
+    def run(self, name:str, command:list[str], env:dict[str,str]) -> int:
+        ''' Run `command` with `env` added to our environment, copying its
+            output, and return its exit status.
+        '''
+        with trace.command_span(command) as rec, \
+                Popen(command, env={ **os.environ, **env },
+                      stdin=DEVNULL, stdout=PIPE, stderr=PIPE) as proc:
+            assert proc.stdout is not None and proc.stderr is not None
+            errcopy = Thread(target=self.copy,
+                args=(name, proc.stderr, sys.stderr))
+            errcopy.start()
+            self.copy(name, proc.stdout, sys.stdout)
+            errcopy.join()
+            proc.wait()
+            rec['status'] = proc.returncode
+        return proc.returncode
+
+    def copy(self, name:str, src:IO[bytes], dst:TextIO):
+        prefix = f'{name:<{self.width}} | '.encode('UTF-8')
+        for line in src:
+            if not line.endswith(b'\n'):  line += b'\n'
+            with self.lock:
+                dst.flush()         # anything already written as text
+                dst.buffer.write(prefix + line)
+                dst.buffer.flush()
+
+    def message(self, text:str):
+        ' Print `text` to stderr, as `drcall()` does dry-run commands. '
+        with self.lock:
+            print(text, file=sys.stderr, flush=True)
+
+def print_summary(conf:Config, results:list[Result]):
+    ''' Print the exit status of each container's command. This is our
+        output (like that of the commands) and so is printed even with
+        ``--quiet``, except that if all succeeded we then print only the
+        count.
+    '''
+    failed = sum(not r.ok for r in results)
+    print('----- {} containers: {} succeeded, {} failed'.format(
+        len(results), len(results) - failed, failed), flush=True)
+    width = max(len(r.name) for r in results)
+    for r in results:
+        status = 'not run' if r.status is None else f'exit {r.status}'
+        qprint(conf.quiet, f'{r.name:<{width}}  {status:<8} {r.seconds:7.2f}s',
+            force_print=not r.ok, flush=True)
+
+####################################################################
+#   Parallel image builds
+
+@dataclass
+class Build:
+    base_image  : str
+    image       : str
+    log         : Path
+    state       : str = 'waiting'     # building, ok, failed
+    start       : float|None = None
+    end         : float|None = None
+    refresh     : Refresh|None = None
+
+    def seconds(self, now:float) -> float:
+        if self.start is None:  return 0.0
+        return (self.end or now) - self.start
+
+def build_images(run:BuildImages) -> int:
+    ''' Build the images, returning 0 if all builds succeeded or 1 if
+        any failed. Each build's output goes to a log file; these and a
+        ``summary.json`` are put in a new directory under `build_logs()`.
+    '''
+    conf = run.conf
+    base_images = expand_names(run.base_images, lambda: list(image.BASE_IMAGES))
+    if not base_images:
+        die('No base images match {}'.format(' '.join(run.base_images)))
+    docker.docker_setup()
+
+    started = datetime.now()
+    logdir = build_logs() \
+        / '{}.{}'.format(started.strftime('%Y%m%dT%H%M%S'), os.getpid())
+    logdir.mkdir(parents=True)
+    confs = { b: replace(conf, base_image=b) for b in base_images }
+    builds = [ Build(b, image.image_alias(c),
+                     logdir / (b.replace(':', '.') + '.log'))
+               for b, c in confs.items() ]
+    status = BuildStatus(builds, conf.quiet)
+
+    def build(b:Build) -> None:
+        with open(b.log, 'w', encoding='UTF-8', buffering=1) as log:
+            status.update(b, 'building')
+            try:
+                if conf.refresh:
+                    b.refresh = image.try_refresh_image(
+                        confs[b.base_image], log)
+                    ok = b.refresh is not None
+                else:
+                    ok = image.try_build_image(confs[b.base_image], log)
+            #   A `die()` (whose message has gone to our stderr) fails
+            #   just this build, not the whole batch.
+            except (Exception, SystemExit) as e:
+                print(f'{type(e).__name__}: {e}', file=log)
+                ok = False
+            status.update(b, 'ok' if ok else 'failed')
+
+    with status, ThreadPoolExecutor(max_workers=run.jobs) as pool:
+        list(pool.map(build, builds))
+
+    summary = logdir/'summary.json'
+    summary.write_text(json.dumps(build_summary(builds, started, run.jobs),
+        indent=2) + '\n')
+    failed = [ b.base_image for b in builds if b.state != 'ok' ]
+    qprint(conf.quiet, '{} {} images, {} failed; logs and summary in {}'
+        .format('Refreshed' if conf.refresh else 'Built', len(builds),
+            len(failed), logdir), force_print=bool(failed))
+    if conf.refresh and not conf.dry_run:
+        for b in builds:
+            if b.refresh is None:  continue
+            qprint(conf.quiet, '{}: saved {} over a full rebuild'.format(
+                b.image, b.refresh.saved()))
+    return 1 if failed else 0
+
+def build_logs() -> Path:
+    ''' The directory holding a subdirectory of logs for each run of
+        `build_images()`.
+    '''
+    return host_state() / 'build'
+
+def build_summary(builds:list[Build], started:datetime, jobs:int) -> dict:
+    now = time.monotonic()
+    return {
+        'started':  started.isoformat(timespec='seconds'),
+        'seconds':  round((datetime.now() - started).total_seconds(), 3),
+        'jobs':     jobs,
+        'failed':   [ b.base_image for b in builds if b.state != 'ok' ],
+        'builds':   [ { 'base_image': b.base_image, 'image': b.image,
+                        'ok': b.state == 'ok',
+                        'seconds': round(b.seconds(now), 3),
+                        'log': str(b.log),
+                        **({ 'refresh': asdict(b.refresh) } if b.refresh
+                           else {}), }
+                      for b in builds ],
+    }
+
+class BuildStatus:
+    ''' Displays the state of each build. On a terminal this is a table
+        redrawn in place every `INTERVAL` seconds while it's in use as a
+        context manager; otherwise a line is printed as each build starts
+        and finishes (unless `quiet`).
+    '''
+    INTERVAL = 0.5
+
+    def __init__(self, builds:list[Build], quiet:bool, out:TextIO|None=None):
+        self.builds = builds
+        self.quiet = quiet
+        self.out = sys.stdout if out is None else out
+        self.live = self.out.isatty()
+        self.width = max(len(b.base_image) for b in builds)
+        self.lock = Lock()
+        self.drawn = 0          # lines of the table currently on screen
+        self.done = False
+        self.refresher:Thread|None = None
+
+    def update(self, build:Build, state:str):
+        with self.lock:
+            now = time.monotonic()
+            if state == 'building':  build.start = now
+            else:                    build.end = now
+            build.state = state
+            if not self.live:
+                qprint(self.quiet, '{:<{}}  {:<8} {:7.1f}s'.format(
+                    build.base_image, self.width, state, build.seconds(now)),
+                    force_print=state == 'failed', file=self.out, flush=True)
+
+    def rows(self) -> list[str]:
+        now = time.monotonic()
+        return [ '{:<{}}  {:<8} {:7.1f}s  {}'.format(b.base_image, self.width,
+                    b.state, b.seconds(now), b.image)
+                 for b in self.builds ]
+
+    def draw(self):
+        with self.lock:
+            up = f'\x1b[{self.drawn}F' if self.drawn else ''
+            self.out.write(up + ''.join(r + '\x1b[K\n' for r in self.rows()))
+            self.out.flush()
+            self.drawn = len(self.builds)
+
+    def refresh(self):
+        while not self.done:
+            self.draw()
+            time.sleep(self.INTERVAL)
+
+    def __enter__(self):
+        if self.live:
+            self.refresher = Thread(target=self.refresh, daemon=True)
+            self.refresher.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done = True
+        if self.refresher is not None:
+            self.refresher.join()
+            self.draw()         # the final states
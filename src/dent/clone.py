@@ -0,0 +1,129 @@
+''' dent.clone - copy a configured container into new containers
+
+    ``dent --clone SOURCE NAME ...`` commits container SOURCE to an image
+    and creates containers NAME ... from that, several at once, each just
+    as Dent creates any container (see `dent.container.run_command()`):
+    with its own Dent share, the host's ``XDG_*`` variables, its own
+    hostname, and so on. The files in SOURCE are copied; its Dent share
+    and other mounts, and the ``docker run`` options it was created with,
+    are not (give ``-C``, ``-r``, ``-s`` and ``-S`` again for the clones).
+
+    The committed image is labelled with the state of SOURCE when it was
+    committed (see `source_state()`), so later clones of an unchanged
+    SOURCE use it rather than committing it again.
+'''
+
+from    concurrent.futures  import ThreadPoolExecutor
+from    dataclasses  import replace
+from    subprocess  import DEVNULL
+from    typing  import Any
+import  sys
+
+from    dent  import docker, locks
+from    dent.configure  import CloneContainer, Config
+from    dent.container  import (
+        dent_share, last_entry, own_caches, run_command)
+from    dent.image  import CLONE_LABEL, HASH_LABEL, short_id
+from    dent.util  import LABEL_PREFIX, PROGNAME, die, qprint
+
+#   Committed images are named CLONE_REPO:SOURCE.STATE (STATE abbreviated).
+#   These are labelled `CLONE_LABEL` with the ID of the source container
+#   and `SOURCE_LABEL` with its `source_state()`.
+CLONE_REPO   = PROGNAME + '/clone'
+SOURCE_LABEL = LABEL_PREFIX + 'clone-state'
+
+def clone(run:CloneContainer) -> int:
+    ''' Create the clones, returning 0 if all were created or 1 if any
+        could not be.
+    '''
+    conf = run.conf
+    docker.docker_setup()
+    source = docker.docker_inspect('container', run.source)
+    if source is None:
+        die("No such container '{}'".format(run.source))
+    existing = set(docker.docker_container_names()).intersection(run.names)
+    if existing:
+        die('Containers already exist: {}'.format(' '.join(sorted(existing))))
+
+    image = clone_image(conf, run.source, source)
+    if image is None:  return 1
+    with ThreadPoolExecutor(max_workers=run.jobs) as pool:
+        created = list(pool.map(
+            lambda name: create_clone(conf, name, image), run.names))
+    failed = [ n for n, ok in zip(run.names, created) if not ok ]
+    qprint(conf.quiet, "Created {} of {} clones of '{}'{}".format(
+        len(run.names) - len(failed), len(run.names), run.source,
+        '; failed: ' + ' '.join(failed) if failed else ''),
+        force_print=bool(failed))
+    return 1 if failed else 0
+
+def source_state(name:str, inspect:dict[str,Any]) -> str:
+    ''' A hash of what changes to container `name`, with inspect data
+        `inspect`, as it's used: its ID, when it was last started and
+        entered by Dent, and the files changed, added or deleted since it
+        was created. (Changing the contents of an already changed file
+        without entering through Dent or restarting the container is
+        not noticed.)
+    '''
+    from    hashlib  import sha256
+    h = sha256(b'dent-clone 1\0')
+    for part in (inspect['Id'], inspect['State'].get('StartedAt', ''),
+            str(last_entry(name) or ''),
+            *docker.docker_container_changes(name)):
+        h.update(part.encode('UTF-8') + b'\0')
+    return h.hexdigest()
+
+def clone_image(conf:Config, name:str, inspect:dict[str,Any]) -> str|None:
+    ''' Return the image committed from container `name` in its current
+        state, committing it if there isn't one, or `None` if the commit
+        failed. Older commits of the container are removed, unless they're
+        still used.
+    '''
+    state = source_state(name, inspect)
+    tag = '{}:{}.{}'.format(CLONE_REPO, name, state[:12])
+    with locks.hold('image', f'{CLONE_REPO}:{name}', quiet=conf.quiet):
+        images = docker.docker_images(f'{CLONE_LABEL}={inspect["Id"]}')
+        for image in images:
+            if image['Labels'].get(SOURCE_LABEL) == state:
+                qprint(conf.quiet, "Using image {} committed from '{}',"
+                    ' unchanged since'.format(short_id(image['Id']), name))
+                return image['Id']
+        qprint(conf.quiet, "Committing container '{}' to image '{}'"
+            .format(name, tag))
+        #   Without its hash label, the image can't be taken for the image
+        #   the container was created from.
+        if docker.drcall(conf, docker.DOCKER_COMMAND + ('commit',
+                f'--change=LABEL {CLONE_LABEL}={inspect["Id"]}',
+                f'--change=LABEL {SOURCE_LABEL}={state}',
+                f'--change=LABEL {HASH_LABEL}=""', name, tag),
+                stdout=DEVNULL) != 0:
+            print("{}: Cannot commit container '{}'".format(PROGNAME, name),
+                file=sys.stderr)
+            return None
+        for image in images:
+            #   Removing by tag leaves the image while clones use it.
+            docker.drcall(conf, docker.DOCKER_COMMAND + ('image', 'rm',
+                *(image['RepoTags'] or [image['Id']])),
+                stdout=DEVNULL, stderr=DEVNULL)
+    return tag
+
+def create_clone(conf:Config, name:str, image:str) -> bool:
+    ' Create and start container `name` from `image`, returning success. '
+    conf = replace(conf, CONTAINER_NAME=name)
+    with locks.hold('container', name, quiet=conf.quiet):
+        if docker.docker_inspect('container', name) is not None:
+            print("{}: Container '{}' already exists".format(PROGNAME, name),
+                file=sys.stderr)
+            return False
+        share = dent_share(conf)
+        (share / 'entry-script').mkdir(parents=True, exist_ok=True)
+        qprint(conf.quiet, "Creating container '{}' from image '{}'"
+            .format(name, image))
+        if docker.drcall(conf, run_command(conf, image, share),
+                stdout=DEVNULL) != 0:
+            return False
+        if not own_caches(conf):
+            print("{}: Cannot give the caches in '{}' to their user"
+                .format(PROGNAME, name), file=sys.stderr)
+            return False
+        return True
@@ -1,15 +1,20 @@
 ''' dent.configure - program configuration from command-line arguments '''
 
-from    argparse  import (
-        ArgumentParser, REMAINDER, RawDescriptionHelpFormatter)
 from    dataclasses  import dataclass
-from    textwrap import dedent
 from    typing  import Literal, get_args
+import  sys
 
 #   Names of the files that -P can print; the functions producing their
 #   text are in `dent.image.PRINT_FILE_ARGS`, whose keys mypy checks
 #   against this type.
-PrintFileName = Literal['dockerfile', 'setup-pkg', 'setup-user']
+PrintFileName = Literal['dockerfile', 'setup-pkg', 'setup-refresh',
+    'setup-user']
+
+ImageCacheAction = Literal['list', 'prune']
+
+#   Names of the caches that --cache can mount; where each is mounted is
+#   in `dent.container.CACHES`, whose keys mypy checks against this type.
+CacheName = Literal['xdg', 'pip', 'go-build', 'npm', 'cargo', 'go']
 
 ####################################################################
 #   Commands: requests that main() do something entirely different
@@ -27,7 +32,74 @@ class PrintFile:
     file        : PrintFileName
     base_image  : str|None      # the file contents depend on this
 
-Command = PrintVersion | ListBaseImages | PrintFile
+@dataclass(frozen=True)
+class RunBatch:
+    ''' Run the command in each of the containers named by `names`, which
+        may be glob patterns, at most `jobs` at a time. `conf` gives the
+        command and other options; its CONTAINER_NAME is unused.
+    '''
+    names       : tuple[str,...]
+    jobs        : int
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class BuildImages:
+    ''' Build the images for `base_images`, which may be glob patterns
+        matching known base images, at most `jobs` at a time. `conf` gives
+        the tag and other build options; its CONTAINER_NAME is unused.
+    '''
+    base_images : tuple[str,...]
+    jobs        : int
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class CloneContainer:
+    ''' Create containers `names` as copies of container `source`, at most
+        `jobs` at a time (see `dent.clone`). `conf` gives the creation
+        options; its CONTAINER_NAME is unused.
+    '''
+    source      : str
+    names       : tuple[str,...]
+    jobs        : int
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class ImageCache:
+    ' List or prune the images Dent has built, by build context hash. '
+    action      : ImageCacheAction
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class Status:
+    ' List the user\'s Dent containers (see `dent.inventory`). '
+
+@dataclass(frozen=True)
+class StopIdle:
+    ''' Stop the user's Dent containers that have been idle for `idle`
+        seconds (see `dent.inventory.stop_idle()`). `conf` gives the
+        options; its CONTAINER_NAME is unused.
+    '''
+    idle        : float
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class CollectGarbage:
+    ''' Remove the user's unused Dent images, pooled containers and shares
+        at least `max_age` seconds old, but for the newest `keep` images of
+        each base image and tag (see `dent.garbage`). `conf` gives the
+        options; its CONTAINER_NAME is unused.
+    '''
+    max_age     : float
+    keep        : int
+    conf        : 'Config'
+
+@dataclass(frozen=True)
+class RunHelper:
+    ' Run the resident helper (see `dent.helper`) until interrupted. '
+
+Command = PrintVersion | ListBaseImages | PrintFile | RunBatch | BuildImages \
+    | CloneContainer | ImageCache | Status | StopIdle | CollectGarbage \
+    | RunHelper
 
 @dataclass
 class Config:
@@ -41,32 +113,60 @@ class Config:
     '''
     #   parseargs() returns a Command instead of constructing this when
     #   given the options that may replace CONTAINER_NAME (--version, -L,
-    #   -P), so the name is always present here.
+    #   -P, --status, --helper), so the name is always present here. (-M,
+    #   --build, --clone, --image-cache, --stop-idle and --gc are the
+    #   exception: their Commands carry a Config with an empty name.)
     CONTAINER_NAME  : str
     COMMAND         : list[str]
     base_image      : str|None
+    cache           : list[CacheName]
     dry_run         : bool
+    entry_script    : bool
     env_copy        : list[str]
     force_rebuild   : bool
     image           : str|None
     keep_tmpdir     : bool
+    native_exec     : bool
+    pool            : int
     progress        : bool
     quiet           : bool
+    refresh         : bool
     run_opt         : list[str]
     share_ro        : list[str]
     share_rw        : list[str]
     tag             : str|None
     tmpdir          : str|None
+    trace           : bool
 
     @staticmethod
     def testconfig(**kwargs) -> 'Config':
-        defaults:dict = { 'CONTAINER_NAME':'Xcname', 'COMMAND':[],
-            'base_image':None, 'dry_run':False, 'env_copy':[],
-            'force_rebuild':False, 'image':None, 'keep_tmpdir':False,
-            'progress':False, 'quiet':False, 'run_opt':[], 'share_ro':[],
-            'share_rw':[], 'tag':None, 'tmpdir':None,
-            }
-        return Config(**(defaults|kwargs))
+        defaults:dict = { 'CONTAINER_NAME':'Xcname', 'COMMAND':[] }
+        return Config(**(defaults|option_defaults()|kwargs))
+
+def option_defaults() -> dict:
+    ''' The `Config` values when no options are given. These must agree with
+        the defaults `parse_options()` produces.
+    '''
+    return { 'base_image':None, 'cache':[], 'dry_run':False,
+        'entry_script':False,
+        'env_copy':[],
+        'force_rebuild':False, 'image':None, 'keep_tmpdir':False,
+        'native_exec':False, 'pool':0, 'progress':False, 'quiet':False,
+        'refresh':False, 'run_opt':[], 'share_ro':[],
+        'share_rw':[], 'tag':None, 'tmpdir':None, 'trace':False,
+        }
+
+#   Used when no command is given for the container.
+DEFAULT_COMMAND = ['bash', '-l']
+
+#   Default for -j: most of the work is done by the Docker daemon and the
+#   processes in the containers, not us.
+DEFAULT_JOBS = 4
+
+#   Defaults for --gc-age and --gc-keep: old enough that nothing removed is
+#   likely to be wanted back, and one image kept to go back to.
+DEFAULT_GC_AGE  = 7.0
+DEFAULT_GC_KEEP = 1
 
 def parseargs(argv:list[str]|None=None) -> Command|Config:
     ''' Parse the command line, returning a `Command` for options that
@@ -76,6 +176,23 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
         This is pure but for one exception: ArgumentParser itself prints
         and exits for bad arguments and --help.
     '''
+    if argv is None:  argv = sys.argv[1:]
+    #   The most common invocation by far, ``dent NAME [COMMAND ...]``, has
+    #   no options, and everything after the container name (less a ``--``
+    #   just after it, as argparse would remove) is the command. We handle
+    #   that here, saving the time to import and set up argparse.
+    if argv and not argv[0].startswith('-'):
+        command = argv[2:] if argv[1:2] == ['--'] else argv[1:]
+        return Config(CONTAINER_NAME=argv[0],
+            COMMAND=command or list(DEFAULT_COMMAND), **option_defaults())
+    return parse_options(argv)
+
+def parse_options(argv:list[str]) -> Command|Config:
+    ' The full argument parsing for `parseargs()`. '
+    from    argparse  import (
+            ArgumentParser, REMAINDER, RawDescriptionHelpFormatter)
+    from    textwrap import dedent
+
     p = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
         description=dedent('''
             Start a new process in a Docker container, creating the container
@@ -87,10 +204,14 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
     p.add_argument('-n', '--dry-run', action='store_true',
         help="don't execute docker image commands, just print them on stderr")
     p.add_argument('-q', '--quiet', action='store_true')
+    p.add_argument('--trace', action='store_true',
+        help='on exit (or just before the final `docker exec`), print to'
+        ' stderr the time taken by each phase and Docker command or request;'
+        ' see also $DENT_TRACE_LOG')
 
     #   Options that apply to building images and containers
     p.add_argument('--keep-tmpdir', action='store_true',
-        help='when done, do not delete tmpdir containing build files')
+        help='write build files to a tmpdir and do not delete it when done')
     p.add_argument('-B', '--base-image',
         help='base image from which to build container image')
     p.add_argument('-V', '--progress', action='store_true',
@@ -98,6 +219,9 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
     p.add_argument('-R', '--force-rebuild', action='store_true',
         help='untag any existing image and rebuild it, ignoring cached images'
              " (only if container doesn't exist)")
+    p.add_argument('--refresh', action='store_true',
+        help='with --build, upgrade the packages in the existing image as'
+        ' a new layer rather than building it again')
     p.add_argument('-r', '--run-opt', action='append', default=[],
         help="command-line option for 'docker run'; may be specifed multiple"
             " times. Use '-r=-e=FOO=bar' syntax!")
@@ -107,7 +231,15 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
     p.add_argument('-S', '--share-rw', action='append', default=[],
         help='Read-write bind mount the given directories to the same paths'
             ' inside the container. Relative paths are relative to $HOME.')
-    p.add_argument('--tmpdir', help='directory to use for Docker build context')
+    p.add_argument('-C', '--cache', choices=get_args(CacheName),
+        action='append', default=[], help='mount your shared volume for'
+        ' this tool or build cache at its usual path in the new container'
+        ' (created if necessary); may be specified multiple times')
+    p.add_argument('--pool', metavar='N', type=int, default=0,
+        help='when creating a container, claim a pre-started one for the'
+        ' image if available, and keep N of them ready in the background')
+    p.add_argument('--tmpdir', help='directory in which to write the Docker'
+        ' build context (default: send it to `docker build` from memory)')
 
     #   Mutually-exclusive options to determine image name
     pi = p.add_mutually_exclusive_group()
@@ -117,9 +249,37 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
         help="tag to use for image (default: username); cannot be used with -i")
 
     #   Options that apply to entering containers
+    p.add_argument('-M', '--multi', metavar='NAME', action='append',
+        default=[], help='run the command in this container, creating it if'
+        ' necessary; may be specified multiple times, and may be a glob'
+        ' pattern matching existing containers. All arguments after the'
+        ' options are the command.')
+    p.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+        help='with -M, --build or --clone, the number of containers to run'
+        ' the command in, images to build or containers to create at once'
+        f' (default: {DEFAULT_JOBS})')
+    p.add_argument('--gc-age', metavar='DAYS', type=float,
+        default=DEFAULT_GC_AGE, help='with --gc, remove only what is at'
+        f' least this many days old (default: {DEFAULT_GC_AGE:g})')
+    p.add_argument('--gc-keep', metavar='N', type=int,
+        default=DEFAULT_GC_KEEP, help='with --gc, keep the newest N unused'
+        f' images of each base image and tag (default: {DEFAULT_GC_KEEP})')
+    p.add_argument('--clone', metavar='SOURCE',
+        help='instead of entering a container, create the named containers'
+        ' (all arguments after the options) as copies of container SOURCE,'
+        ' committing it to an image unless it has not changed since last'
+        ' cloned')
     pi.add_argument('-e', '--env-copy', metavar='NAME',
         action='append', default=[], help='environment passthrough: copy'
         ' into the container (at entry time) the named env vars')
+    p.add_argument('--native-exec', action='store_true',
+        help='when stdin is not a terminal, run the command through the'
+        ' Docker daemon socket with Dent copying its input and output,'
+        ' rather than with `docker exec`; faster for large amounts of data')
+    p.add_argument('--entry-script', action='store_true',
+        help='pass the working directory and -e env vars into the container'
+        ' in a script written to the Dent share, rather than in the'
+        ' environment of `docker exec`')
 
     #   We must have either a container name or one of the options that
     #   requests information.
@@ -132,6 +292,26 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
         help='instead of entering a container, print given file to stdout')
     pe.add_argument('--version', action='store_true',
         help='show program version information')
+    pe.add_argument('--image-cache', choices=get_args(ImageCacheAction),
+        help="list the images Dent has built for you and whether they're"
+        ' current, or remove the stale ones')
+    pe.add_argument('--status', action='store_true',
+        help='list your Dent containers with their state, image, age, last'
+        ' entry and disk use')
+    pe.add_argument('--stop-idle', metavar='HOURS', type=float,
+        help='stop your Dent containers not entered for this many hours'
+        ' and with no commands running from `docker exec`; they are'
+        ' restarted quietly when next entered')
+    pe.add_argument('--gc', action='store_true',
+        help='remove your Dent images, pooled containers and Dent shares'
+        ' that nothing uses, and print the space freed')
+    pe.add_argument('--helper', action='store_true',
+        help='run the resident helper that makes entering containers faster'
+        ' for as long as it runs')
+    pe.add_argument('--build', metavar='BASE_IMAGE', action='append',
+        help='instead of entering a container, build the image for this base'
+        ' image; may be specified multiple times, and may be a glob pattern'
+        ' matching the base images listed by -L')
 
     #   All remaining args are the command to run in the container.
     p.add_argument('COMMAND', nargs=REMAINDER, default='SEE BELOW',
@@ -142,13 +322,79 @@ def parseargs(argv:list[str]|None=None) -> Command|Config:
     if ns.version:              return PrintVersion()
     if ns.list_base_images:     return ListBaseImages()
     if ns.print_file:           return PrintFile(ns.print_file, ns.base_image)
+    if ns.helper:               return RunHelper()
+    if ns.status:
+        if ns.COMMAND:  p.error('--status takes no command')
+        if ns.multi:    p.error('--status cannot be used with -M')
+        return Status()
+    if ns.image_cache:
+        if ns.COMMAND:  p.error('--image-cache takes no command')
+        if ns.multi:    p.error('--image-cache cannot be used with -M')
+        ns.CONTAINER_NAME = ''
+    if ns.stop_idle is not None:
+        if ns.COMMAND:  p.error('--stop-idle takes no command')
+        if ns.multi:    p.error('--stop-idle cannot be used with -M')
+        if ns.stop_idle <= 0:  p.error('--stop-idle must be positive')
+        ns.CONTAINER_NAME = ''
+    if ns.gc:
+        if ns.COMMAND:  p.error('--gc takes no command')
+        if ns.multi:    p.error('--gc cannot be used with -M')
+        if ns.gc_age < 0 or ns.gc_keep < 0:
+            p.error('--gc-age and --gc-keep must not be negative')
+        ns.CONTAINER_NAME = ''
 
     #   `default=` does not work with nargs=REMAINDER. We cannot use
     #   nargs='*' because that will cause options in the remainder to be
     #   interpreted as Dent options unless the user adds `--` between,
     #   which is inconvenient.
-    if not ns.COMMAND: ns.COMMAND = ['bash', '-l']
+    if ns.build:
+        if ns.COMMAND:      p.error('--build takes no command')
+        if ns.base_image or ns.image or ns.tmpdir or ns.multi:
+            p.error('--build cannot be used with -B, -i, -M or --tmpdir')
+        if ns.refresh and ns.force_rebuild:
+            p.error('--refresh cannot be used with -R')
+        ns.CONTAINER_NAME = ''
+    elif ns.refresh:
+        p.error('--refresh can be used only with --build')
+    if ns.clone:
+        if ns.multi or ns.build or ns.base_image or ns.image or ns.pool:
+            p.error('--clone cannot be used with -M, --build, -B, -i or'
+                ' --pool')
+        #   The container name and the "command" are the clones' names.
+        if ns.CONTAINER_NAME is None:
+            p.error('--clone requires the names of the new containers')
+        ns.COMMAND.insert(0, ns.CONTAINER_NAME)
+        ns.CONTAINER_NAME = ''
+    if ns.multi:
+        #   There is no container name; it's the start of the command.
+        if ns.CONTAINER_NAME is not None:
+            ns.COMMAND.insert(0, ns.CONTAINER_NAME)
+        ns.CONTAINER_NAME = ''
+        if not ns.COMMAND:  p.error('-M requires a command')
+    if ns.jobs < 1:         p.error('-j must be at least 1')
+    if ns.pool < 0:         p.error('--pool must not be negative')
+    if not ns.COMMAND: ns.COMMAND = list(DEFAULT_COMMAND)
 
     args = vars(ns)
-    del args['version'], args['list_base_images'], args['print_file']
+    names, jobs = tuple(args.pop('multi')), args.pop('jobs')
+    build, image_cache = args.pop('build'), args.pop('image_cache')
+    stop_idle, clone = args.pop('stop_idle'), args.pop('clone')
+    gc, gc_age, gc_keep = args.pop('gc'), args.pop('gc_age'), \
+        args.pop('gc_keep')
+    del args['version'], args['list_base_images'], args['print_file'], \
+        args['helper'], args['status']
+    if image_cache:
+        return ImageCache(image_cache, Config(**args))
+    if stop_idle is not None:
+        return StopIdle(stop_idle * 3600, Config(**args))
+    if gc:
+        return CollectGarbage(gc_age * 86400, gc_keep, Config(**args))
+    if build:
+        return BuildImages(tuple(build), jobs, Config(**args))
+    if clone:
+        names = tuple(args['COMMAND'])
+        args['COMMAND'] = list(DEFAULT_COMMAND)
+        return CloneContainer(clone, names, jobs, Config(**args))
+    if names:
+        return RunBatch(names, jobs, Config(**args))
     return Config(**args)
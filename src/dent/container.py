@@ -1,24 +1,81 @@
 ''' dent.container - container creation, startup and entry '''
 
+from    dataclasses  import replace
 from    datetime  import datetime
 from    pathlib  import Path
-from    platform  import node
+from    platform  import machine, node
 from    subprocess  import DEVNULL
 from    sys  import stdin, stdout, stderr, argv
 from    textwrap  import dedent
-import  os, shlex, time
+import  os, re, shlex, time
 
-from    dent  import docker, image
-from    dent.configure  import Config
-from    dent.util  import PWENT, die, qprint
+from    dent  import docker, locks, trace
+from    dent.configure  import CacheName, Config
+from    dent.util  import LABEL_PREFIX, PWENT, die, qprint, state_home
 
 ####################################################################
 #   Container entry.
 
 def enter_container(conf:Config):
-    ' Enter the container, doing any dependent actions necessary. '
-    docker.docker_setup()
+    ''' Enter the container, doing any dependent actions necessary.
 
+        The common case, entering an existing running container, is kept
+        to a single inspect of the container (which also serves as our
+        check for access to the Docker daemon) before the ``docker exec``.
+    '''
+    container = docker.docker_setup_inspect('container', conf.CONTAINER_NAME)
+    has_share = ready_container(conf, container)
+
+    #   Normally, rather than copying stdin/out/err between what the Docker
+    #   daemon is sending/receiving and our stdin/out/err ourselves, we just
+    #   use the existing code in the `docker` command to do this, doing a
+    #   "process tail call optimization" since all we would do is return the
+    #   exit code anyway. With --native-exec we do the copying for piped
+    #   input, which can be much faster for large amounts of data.
+    tty = stdin.isatty()
+    stdout.flush(); stderr.flush()  # Ensure all our output is complete
+                                    # before this process is replaced.
+    if conf.native_exec and not tty and not conf.dry_run \
+            and docker.ENGINE is not None:
+        return native_exec(conf, has_share)
+    command, env = entry_command(conf, has_share, tty=tty)
+    if not conf.dry_run:
+        if has_share:  record_entry(conf)
+        trace.finish(exec=command)
+        os.execvpe(command[0], command, { **os.environ, **env })
+        #   Never returns
+    else:
+        print(' '.join(command), file=stderr)
+        exit(0)
+
+def native_exec(conf:Config, has_share:bool) -> int:
+    ''' Run the command in the container through the Engine API, copying
+        its input and output ourselves (see `dent.stream`), and return its
+        exit code.
+    '''
+    from    dent  import engine, stream
+    env, argv = entry_exec(conf, has_share)
+    if has_share:  record_entry(conf)
+    try:
+        with trace.phase('native_exec'):
+            return stream.run_exec(docker.ENGINE, conf.CONTAINER_NAME,
+                argv, [ f'{name}={value}' for name, value in env.items() ])
+    except engine.EngineError as e:
+        die(f'Cannot exec in container: {e}')
+    except OSError as e:
+        die(f'Lost connection to the exec: {e}')
+
+@trace.phase('ready_container')
+def ready_container(conf:Config, container:dict|None, *,
+        new_only_opts:bool=False) -> bool:
+    ''' Given the inspect data for the container (`None` if it does not
+        exist), create and/or start it as necessary, returning `True` if
+        it has the Dent share.
+
+        Options that affect only the creation of a container (-B, -i, -r,
+        -s) are an error when it already exists unless `new_only_opts` is
+        set, in which case they are ignored for existing containers.
+    '''
     #   Any arguments that modify the `docker run` command are not
     #   compatible with existing containers where `docker run` has
     #   already been executed.
@@ -35,101 +92,201 @@ def enter_container(conf:Config):
         or (len(conf.run_opt) > 0)
         or (len(conf.share_ro) > 0)
         or (len(conf.share_rw) > 0)
+        or (len(conf.cache) > 0)
         )
     not_on_existing_msg \
-        = '-B, -i, -r and -s options cannot affect existing containers'
+        = '-B, -C, -i, -r and -s options cannot affect existing containers'
 
-    container = docker.docker_inspect('container', conf.CONTAINER_NAME)
+    started:float|None = None   # Unix time we started the container, if we did
+    quiet = conf.quiet
+    if container is None:
+        #   Other Dent processes may be trying to create it, too: one does
+        #   while the others wait for it, then use the container it made
+        #   (for which the creation options were meant).
+        with locks.hold('container', conf.CONTAINER_NAME, quiet=conf.quiet):
+            container = docker.docker_inspect('container', conf.CONTAINER_NAME)
+            if container is None:
+                started = new_container(conf)
+            else:
+                new_only_opts = True
     if container is None:
-        create_container(conf)      # Also starts, with the shared dir
         has_share = True
     else:   # container exists (but might not be started yet)
-        if not_on_existing:
+        if not_on_existing and not new_only_opts:
             die(not_on_existing_msg)
         if not container['State']['Running']:
-            docker.docker_container_start(conf)
+            #   A container `dent --stop-idle` stopped is restarted without
+            #   comment: as far as its user is concerned, it never stopped.
+            quiet = conf.quiet or resumed_idle(conf)
+            started = time.time()
+            docker.docker_container_start(replace(conf, quiet=quiet))
         #   Only containers created with the shared dir get the startup-file
         #   launcher; a foreign container (possibly without even bash) is
         #   entered directly. The Dent share is identified by the ``Source``
         #   path (i.e. path on the host); the in-container path is taken
         #   care of by the in-container ``dent-share dir`` program.
-        has_share = has_bind(container, source=dent_share(conf))
+        has_share = has_bind(container, source=share_source(dent_share(conf)))
+
+    #   A container we found running needs no further checks; the exec
+    #   will produce a suitable error in the unlikely event it's since
+    #   been stopped.
+    if started is not None:
+        waited = waitforstart(conf, started)
+        if not conf.dry_run:
+            qprint(quiet, "Container '{}' running after {:.3f}s wait" \
+                .format(conf.CONTAINER_NAME, waited))
+    return has_share
+
+def new_container(conf:Config) -> float|None:
+    ''' Create the container, or claim it from the pool, returning the Unix
+        time at which we started it if we must wait for it to be running.
+    '''
+    started:float|None = None
+    if not conf.pool:
+        started = time.time()
+        create_container(conf)      # Also starts, with the shared dir
+        return started
+    from    dent  import pool
+    if not pool.claim(conf):
+        started = time.time()
+        create_container(conf)
+    pool.refill(conf)
+    return started
+
+def entry_command(conf:Config, has_share:bool, *, tty:bool
+        ) -> tuple[list[str],dict[str,str]]:
+    ''' Return the ``docker exec`` command to run `conf.COMMAND` in the
+        (running) container, with the entry context (see `entry_exec()`)
+        if the container `has_share`, and the variables that must be added
+        to the environment it's run with. A terminal is allocated if `tty`
+        is set.
+
+        The values are not on the command line, where other users could
+        read them, but passed through the environment of ``docker`` (and
+        ``sudo``, if used) with a bare ``--env=NAME``.
+    '''
+    env, argv = entry_exec(conf, has_share)
+    command = list(docker.DOCKER_COMMAND)
+    if env and command[0] == 'sudo':
+        command.insert(1, '--preserve-env=' + ','.join(env))
+    command.append('exec')
+    command.append('-i')
+    command.append('--detach-keys=ctrl-@,ctrl-d')
+    if tty:
+        command.append('-t')
+    command += [ '--env=' + name for name in env ]
+    command.append(conf.CONTAINER_NAME)
+    return command + argv, env
 
-    waitforstart(conf)
+#   Prefix of the names under which the --env-copy variables are passed to
+#   the container, to be set under their own names only by the launcher.
+ENV_COPY_PREFIX = 'DENT_ENV_'
+#   A variable name that `sh` can set.
+SH_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
 
+def entry_exec(conf:Config, has_share:bool
+        ) -> tuple[dict[str,str],list[str]]:
+    ''' Return the environment variables and the command to run
+        `conf.COMMAND` in the container, with the entry context (see below)
+        if the container `has_share`.
+    '''
     #   WARNING: The command below must NOT copy $XDG_STATE_DIR or $HOME
     #   into the container. The container was set up with a specifc
     #   $XDG_STATE_HOME (or default $HOME/.local/state) and mounted the
     #   Dent share based on that: different values will silently disable
     #   the entry script as $HOME/.local/bin/dent-share will no longer
     #   be able to find it.
-
-    #   Rather than using `container.exec_run() and then rewriting the same
-    #   code to deal with the copying of stdin/out/err between what the
-    #   Docker daemon is sending/receiving and our stdin/out/err, just use
-    #   the existing code in the `docker` command to do this. We can also
-    #   do a "process tail call optimization" here since all we would do is
-    #   return the exit code anyway.
-    command = list(docker.DOCKER_COMMAND) + ['exec']
-    command.append('-i')
-    command.append('--detach-keys=ctrl-@,ctrl-d')
-    if stdin.isatty():
-        command.append('-t')
-    command.append(conf.CONTAINER_NAME)
-    #   Containers created with the Dent share are entered via a launcher
-    #   that sources a per-entry startup file then execs the requested
-    #   command; the `[ -f ]` guard tolerates a missing file. Others are
-    #   entered directly.
+    env = {}
+    #   The entry context is the host's current working directory and the
+    #   --env-copy variables we have (and whose names the shell can set).
+    #   It's normally passed in the environment of the `docker exec`, but
+    #   may be passed in an entry script written to the Dent share. The
+    #   variables go under `ENV_COPY_PREFIX` names, so that they're not
+    #   set in containers without the launcher, as with an entry script.
+    copied = []
+    if has_share and not conf.entry_script:
+        env['DENT_ENTRY_CWD'] = os.getcwd()
+        copied = [ name for name in conf.env_copy
+                   if name in os.environ and SH_NAME.fullmatch(name) ]
+        env.update((ENV_COPY_PREFIX + name, os.environ[name])
+                   for name in copied)
+    #   A container claimed from a pool was created under another name.
     if has_share:
+        env['DENT_CONTAINER'] = conf.CONTAINER_NAME
+    #   Containers created with the Dent share are entered via a launcher
+    #   that sets up the entry context, if the `dent-share` program is
+    #   present, then execs the requested command. Others are entered
+    #   directly.
+    if not has_share:
+        return env, list(conf.COMMAND)
+    contfile = '$HOME/.local/bin/dent-share'
+    #   We pass a single command to `sh -c` run in the container, which:
+    #   1. Checks to see if `dent-share` is present. (It was installed by
+    #      the image build, but the container might have been created from
+    #      an image that Dent did not build.)
+    #   2. If it's present, sets up the context: changes to the host's cwd
+    #      (if it exists in the container) and sets the copied variables
+    #      or, with an entry script, sources that.
+    #   3. exec's "$@", which will be conf.COMMAND, either the remaining
+    #      arguments given on the `dent` command line or Dent's default
+    #      `bash -l`. (XXX this really should be the user's shell, not
+    #      hardcoded to bash.)
+    if conf.entry_script:
         #   Write even on dry run so we can inspect its contents.
         esfname = write_entry_script(conf)
-        contfile = '$HOME/.local/bin/dent-share'
-        #   We pass a single command to `sh -c` run in the container, which:
-        #   1. Checks to see if the entry script is present. (It was created
-        #      on the host, but container config determines if it's actually
-        #      shared into the container.)
-        #   2. If it's present, sources it with the `.` command.
-        #   3. exec's "$@", which will be conf.COMMAND, either the remaining
-        #      arguments given on the `dent` command line or Dent's default
-        #      `bash -l`. (XXX this really should be the user's shell, not
-        #      hardcoded to bash.)
         cont_sh_c = f'[ -f "{contfile}" ]' \
             f' && eval "$({contfile} cat-entry-script {esfname})"; exec "$@"'
-        command += ['sh', '-c', cont_sh_c, 'argv0'] + conf.COMMAND
     else:
-        command += conf.COMMAND
-    stdout.flush(); stderr.flush()  # Ensure all our output is complete
-                                    # before this process is replaced.
-    if not conf.dry_run:
-        os.execvp(command[0], command)
-        #   Never returns
-    else:
-        print(' '.join(command), file=stderr)
-        exit(0)
+        exports = ''.join( f' export {name}="${ENV_COPY_PREFIX}{name}";'
+                           for name in copied )
+        unsets = ' '.join(['DENT_ENTRY_CWD']
+                          + [ ENV_COPY_PREFIX + name for name in copied ])
+        cont_sh_c = f'[ -f "{contfile}" ]' \
+            ' && { command cd "$DENT_ENTRY_CWD" 2>/dev/null || true;' \
+            f'{exports} }}; unset {unsets}; exec "$@"'
+    return env, ['sh', '-c', cont_sh_c, 'argv0'] + conf.COMMAND
 
-def waitforstart(conf:Config):
-    ''' Wait for a container to start, dieing if it exits immediately.
+#   Seconds we allow a container to take to be running after being started.
+START_TIMEOUT = 5.0
 
-        The `Docker API`_ does not indicate whether it guarantees it won't
-        return from a start call before the container is started. Regardless,
-        we still need to check that it hasn't exited immediately.
+@trace.phase('waitforstart')
+def waitforstart(conf:Config, since:float|None=None) -> float:
+    ''' Wait for a container started at or after Unix time `since` (default
+        now) to be running, dieing if it exits immediately or isn't running
+        within `START_TIMEOUT` seconds. Return the time spent waiting, in
+        seconds.
+
+        The `Docker API`_ start call (which ``docker start`` also uses)
+        doesn't return until the container's process has been started, so
+        usually a single inspect confirms it's running. Otherwise (e.g.,
+        someone else is starting it) we wait on the daemon's event stream
+        for it to start or die. Events are requested from `since` on so
+        that we cannot miss any that happened before we subscribed.
 
         .. Docker API: https://docs.docker.com/engine/api/v1.30/#operation/ContainerStart
     '''
-    if conf.dry_run: return
-    tries = 50
-    while tries > 0:
-        container = docker.docker_inspect('container', conf.CONTAINER_NAME)
+    if conf.dry_run: return 0.0
+    t0 = time.monotonic()
+    if since is None:  since = time.time()
+    name = conf.CONTAINER_NAME
+
+    def running() -> bool:
+        container = docker.docker_inspect('container', name)
         if container is None:
             die("Container '{}' was started but is no longer running" \
-                .format(conf.CONTAINER_NAME))
-        elif container['State']['Running']:
-            break
-        else:
-            time.sleep(0.1)
-            tries -= 1
-    if not tries > 0:
-        die("Cannot start container '{}'".format(conf.CONTAINER_NAME))
+                .format(name))
+        return container['State']['Running']
+
+    if not running():
+        for action in docker.docker_container_events(
+                name, since, time.time() + START_TIMEOUT):
+            if running():
+                break
+            if action == 'die':     # exited immediately after starting
+                die("Cannot start container '{}'".format(name))
+        else:                       # timed out
+            die("Cannot start container '{}'".format(name))
+    return time.monotonic() - t0
 
 ####################################################################
 #   Per-container shared dir and entry startup files.
@@ -154,8 +311,64 @@ def dent_share(conf:Config) -> Path:
         This must agree with the `dent-share` script, which computes the
         same path for the user inside and outside the container.
     '''
-    state = os.environ.get('XDG_STATE_HOME') or Path.home()/'.local'/'state'
-    return Path(state) / 'dent' / conf.CONTAINER_NAME
+    return state_home() / 'dent' / conf.CONTAINER_NAME
+
+#   File in the Dent share whose modification time is that of the last
+#   entry to the container, to within ENTRY_RESOLUTION seconds.
+ENTRY_STAMP = 'last-entry'
+ENTRY_RESOLUTION = 60
+
+def record_entry(conf:Config, now:float|None=None):
+    ''' Note the time of this entry to the container in its Dent share,
+        unless an entry was recorded in the last `ENTRY_RESOLUTION`
+        seconds: a `stat()` costs less than an update of the file.
+    '''
+    if now is None:  now = time.time()
+    stamp = dent_share(conf) / ENTRY_STAMP
+    try:
+        if now - stamp.stat().st_mtime < ENTRY_RESOLUTION:
+            return
+    except OSError:
+        pass                        # not yet recorded
+    try:
+        stamp.touch()
+    except OSError:
+        pass                        # the entry matters more
+
+#   File in the Dent share of a container stopped by `dent --stop-idle`
+#   (see `dent.inventory.stop_idle()`), until it's next started by Dent.
+IDLE_STAMP = 'stopped-idle'
+
+def resumed_idle(conf:Config) -> bool:
+    ''' Whether the container was stopped for being idle, forgetting that
+        it was (except on a dry run) as we are about to start it.
+    '''
+    stamp = dent_share(conf) / IDLE_STAMP
+    if conf.dry_run:  return stamp.exists()
+    try:
+        stamp.unlink()
+        return True
+    except OSError:
+        return False
+
+def last_entry(name:str) -> float|None:
+    ''' The Unix time of the last entry by Dent to container `name`, or
+        `None` if it has not been entered since Dent started recording this.
+    '''
+    try:
+        return (state_home() / 'dent' / name / ENTRY_STAMP).stat().st_mtime
+    except OSError:
+        return None
+
+def share_source(share:Path) -> Path:
+    ''' The host path from which the Dent share `share` is bind-mounted:
+        `share` itself or, for a container claimed from a pool (see
+        `dent.pool`), the pool share to which it's a relative symlink.
+    '''
+    try:
+        return Path(os.path.normpath(share.parent / os.readlink(share)))
+    except OSError:
+        return share
 
 def has_bind(inspect:dict, *, source:Path) -> bool:
     ''' Given the parsed ``docker inspect`` output for a container, return
@@ -166,9 +379,10 @@ def has_bind(inspect:dict, *, source:Path) -> bool:
     return any( m.get('Source') == str(source) and m.get('Type') == 'bind'
                 for m in (inspect.get('Mounts') or []) )
 
+@trace.phase('write_entry_script')
 def write_entry_script(conf:Config) -> str:
-    ''' At each entry write a startup script to be executed inside the
-        container before the user's shell. This is intended to carry
+    ''' With ``--entry-script``, at each entry write a startup script to be
+        executed inside the container before the user's shell. This is intended to carry
         context read *at entry time* from the host into the container
         (CWD, env vars, etc.).
 
@@ -208,22 +422,27 @@ def startup_file_text(conf:Config, now:datetime, environ=None) -> str:
         if var in environ ])
     return '\n'.join([head, envs])
 
+@trace.phase('reap_startup_files')
 def reap_startup_files(scriptdir:Path, keep:int, min_age:float):
     ''' Delete startup files in `scriptdir` beyond the newest `keep`, but never
         any younger than `min_age` seconds.
     '''
     try:
         now = time.time()
-        fs = sorted(scriptdir.glob('startup.*'), key=lambda p: p.stat().st_mtime)
-        for p in fs[:-keep]:
-            if now - p.stat().st_mtime >= min_age:
-                p.unlink(missing_ok=True)
+        #   One scan of the directory and one stat of each file.
+        with os.scandir(scriptdir) as entries:
+            fs = sorted( (e.stat().st_mtime, e.path) for e in entries
+                         if e.name.startswith('startup.') )
+        for mtime, path in fs[:-keep]:
+            if now - mtime >= min_age:
+                Path(path).unlink(missing_ok=True)
     except OSError:
         pass    # best-effort; never fail entry over reaping
 
 ####################################################################
 #   Container setup.
 
+@trace.phase('create_container')
 def create_container(conf:Config):
     ''' Create a new container for persistent use.
 
@@ -234,19 +453,34 @@ def create_container(conf:Config):
         avoid overflowing any old 32-bit systems) and run our actual
         commands or shells with ``docker exec`` in that existing container.
     '''
-    shared_path_opts \
-        = share_args(conf.share_ro, 'ro') + share_args(conf.share_rw, 'rw')
+    from    concurrent.futures  import ThreadPoolExecutor
+    from    dent  import image     # only needed when creating containers
 
-    share = dent_share(conf)
-    (share / 'entry-script').mkdir(parents=True, exist_ok=True)
-    dent_share_opt = '-v={0}:{0}'.format(share)
-
-    #   Pass the host's XDG_* vars through at creation (not on entry) so the
-    #   container's XDG layout — in particular XDG_STATE_HOME, which locates
-    #   the Dent share — matches the host's. `docker exec` inherits these.
-    xdg_env = tuple('--env=' + k
-        for k in sorted(os.environ) if k.startswith('XDG_'))
+    #   Readying the image may mean pulling and building, so it's done in
+    #   another thread while we set up the Dent share.
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='image') as pool:
+        ready = pool.submit(ready_image, conf)
+        share = dent_share(conf)
+        (share / 'entry-script').mkdir(parents=True, exist_ok=True)
+        ready.result()
+    qprint(conf.quiet, "Creating new container '{}' from image '{}' for user {}" \
+        .format(conf.CONTAINER_NAME, image.image_alias(conf), PWENT.pw_name))
+    command = run_command(conf, image.image_alias(conf), share)
+    retcode = docker.drcall(conf, command, stdout=DEVNULL)
+                                            # stdout prints container ID
+    if retcode != 0:
+        die('Failed to create container {} with command:\n{}' \
+            .format(conf.CONTAINER_NAME, ' '.join(command)))
+    if not own_caches(conf):
+        die("Cannot give {} the caches in container '{}'"
+            .format(PWENT.pw_name, conf.CONTAINER_NAME))
 
+@trace.phase('ready_image')
+def ready_image(conf:Config):
+    ''' Build the image for `conf` if it doesn't exist (or with
+        ``--force-rebuild``).
+    '''
+    from    dent  import image
     images = docker.docker_inspect('image', image.image_alias(conf))
     if conf.force_rebuild:
         image.build_image(conf)
@@ -258,22 +492,37 @@ def create_container(conf:Config):
             "Using existing image '{}'".format(image.image_alias(conf)))
     else:
         image.build_image(conf)
+
+def run_command(conf:Config, image:str, share:Path, *opts:str
+        ) -> tuple[str,...]:
+    ''' Return the ``docker run`` command creating container
+        `conf.CONTAINER_NAME` from `image` with the Dent share `share`,
+        the `dent.image.container_labels()`, the `cache_args()` and any
+        further `docker run` `opts`.
+    '''
+    from    dent.image  import BASE_LABEL, container_labels
+    image_labels = container_labels(image)
+    labels = tuple( f'--label={k}={v}' for k, v in image_labels.items() )
+    shared_path_opts \
+        = share_args(conf.share_ro, 'ro') + share_args(conf.share_rw, 'rw') \
+        + cache_args(conf.cache, image_labels.get(BASE_LABEL, image))
+    dent_share_opt = '-v={0}:{0}'.format(share)
+
+    #   Pass the host's XDG_* vars through at creation (not on entry) so the
+    #   container's XDG layout — in particular XDG_STATE_HOME, which locates
+    #   the Dent share — matches the host's. `docker exec` inherits these.
+    xdg_env = tuple('--env=' + k
+        for k in sorted(os.environ) if k.startswith('XDG_'))
+
     user = PWENT.pw_name
-    qprint(conf.quiet, "Creating new container '{}' from image '{}' for user {}" \
-        .format(conf.CONTAINER_NAME, image.image_alias(conf), user))
-    command = docker.DOCKER_COMMAND + ('run',
+    return docker.DOCKER_COMMAND + ('run',
         '--name='+conf.CONTAINER_NAME, '--hostname='+conf.CONTAINER_NAME,
         '--env=HOST_HOSTNAME='+node(),
         '--env=DENT_CONTAINER='+conf.CONTAINER_NAME,
         '--env=LOGNAME='+user, '--env=USER='+user,
-        '--rm=false', '--detach=true', '--tty=false',
+        '--rm=false', '--detach=true', '--tty=false', *labels, *opts,
         *xdg_env, *shared_path_opts, dent_share_opt, *conf.run_opt,
-        image.image_alias(conf), 'tail', '-f', '/dev/null' )
-    retcode = docker.drcall(conf, command, stdout=DEVNULL)
-                                            # stdout prints container ID
-    if retcode != 0:
-        die('Failed to create container {} with command:\n{}' \
-            .format(conf.CONTAINER_NAME, ' '.join(command)))
+        image, 'tail', '-f', '/dev/null' )
 
 def share_args(args, opt):
     ''' Given an iterable of paths, return a list of ``-v`` options for
@@ -286,3 +535,73 @@ def share_args(args, opt):
         p = Path.home().joinpath(s)     # if relative, make absolute
         vs += ['-v={}:{}:{}'.format(p, p, opt)]
     return vs
+
+####################################################################
+#   Shared tool and build caches.
+#
+#   With ``-C NAME`` a container mounts the user's volume for cache NAME
+#   at that cache's usual path under ``$HOME``, so that all the user's
+#   containers share, e.g., their pip downloads and built wheels rather than
+#   each fetching and building them again. Caches holding compiled code are
+#   shared only between containers with the same base image and machine
+#   architecture, which is what that code depends on.
+#
+#   The volumes are named ``dent-cache.USER.NAME`` (with ``.BASE.ARCH``
+#   appended where the ABI matters) and are created by ``docker run`` as
+#   it mounts them, labelled with the user and `CACHE_LABEL`.
+
+CACHE_PREFIX = 'dent-cache.'
+CACHE_LABEL  = LABEL_PREFIX + 'cache'   # the cache's name, on its volumes
+
+#   For each cache, its path relative to $HOME and whether what it holds
+#   depends on the distro and architecture. The key type keeps these in
+#   sync with the -C choices in parseargs().
+CACHES:dict[CacheName,tuple[str,bool]] = {
+    'xdg':      ('.cache',              True),  # everything XDG-conformant
+    'pip':      ('.cache/pip',          True),  # wheels built locally
+    'go-build': ('.cache/go-build',     True),
+    'npm':      ('.npm',                False),
+    'cargo':    ('.cargo/registry',     False), # crate sources only
+    'go':       ('go/pkg/mod',          False), # module sources only
+}
+
+def cache_volume(name:CacheName, base_image:str) -> str:
+    ''' The name of the user's volume for cache `name` in containers
+        created from `base_image` (or images built from it).
+    '''
+    volume = CACHE_PREFIX + f'{PWENT.pw_name}.{name}'
+    if CACHES[name][1]:
+        volume += f'.{base_image}.{machine()}'
+    #   Volume names allow only `[a-zA-Z0-9][a-zA-Z0-9_.-]`.
+    return re.sub(r'[^a-zA-Z0-9_.-]', '-', volume)
+
+def cache_args(names, base_image:str) -> list[str]:
+    ''' Given an iterable of cache names, return a list of ``--mount``
+        options for ``docker run`` that will mount their volumes (see
+        `cache_volume()`), having Docker create any that don't exist.
+    '''
+    from    dent.image  import USER_LABEL
+    return [ '--mount=type=volume,src={},dst={},volume-label={}={},'
+             'volume-label={}={}'.format(
+                cache_volume(n, base_image), Path.home() / CACHES[n][0],
+                USER_LABEL, PWENT.pw_name, CACHE_LABEL, n)
+             for n in dict.fromkeys(names) ]
+
+def own_caches(conf:Config) -> bool:
+    ''' Give the user the cache mount points in the new container
+        `conf.CONTAINER_NAME`, and the directories under ``$HOME`` that
+        Docker created (owned by root) to hold them, returning success.
+        A mount point is the root directory of its volume, so this matters
+        only for new volumes, but is cheap enough to do for every container.
+    '''
+    if not conf.cache:  return True
+    home = Path.home()
+    paths:dict[Path,None] = {}          # an ordered set
+    for n in conf.cache:
+        rel = Path(CACHES[n][0])
+        paths.update((home / p, None) for p in reversed(rel.parents)
+                     if p != Path('.'))
+        paths[home / rel] = None
+    return 0 == docker.drcall(conf, docker.DOCKER_COMMAND + ('exec',
+        '--user=0', conf.CONTAINER_NAME, 'chown', str(PWENT.pw_uid),
+        *map(str, paths)), stdout=DEVNULL)
@@ -1,26 +1,195 @@
-''' dent.docker - Docker "API": execution of `docker` commands '''
+''' dent.docker - Docker "API": daemon queries and `docker` commands
+
+    Queries of daemon state are made directly over the daemon's socket via
+    `dent.engine` when we can use it, otherwise by running ``docker``
+    commands. Commands that change state, and the final ``docker exec``
+    that we replace ourselves with, always use the ``docker`` command.
+'''
 
 #   XXX Consider if we should be using a newer API than call().
-from    subprocess  import call, check_output, DEVNULL, CalledProcessError
+from    collections.abc  import Callable, Iterator
+from    dataclasses  import asdict, dataclass
+from    pathlib  import Path
+from    subprocess  import DEVNULL, PIPE, CalledProcessError, Popen
 from    sys import stdout, stderr
-from    typing  import Any
-import  json
+from    typing  import Any, TypeVar
+import  json, os
 
+from    dent  import engine, helper, trace
 from    dent.configure  import Config
-from    dent.util  import die, qprint
+from    dent.trace  import call, check_output, run
+from    dent.util  import die, host_state, qprint
 
 DOCKER_COMMAND:tuple[str,...] = ('docker',)
+ENGINE:engine.Engine|None = None
+
+####################################################################
+#   Daemon access: how we talk to the daemon and what it supports.
+#
+#   Working this out takes a `docker info` (one of the slowest daemon
+#   calls) and possibly a `sudo -v`, so we cache the result in the host
+#   state dir and re-use it until a call fails because we can no longer
+#   reach the daemon, or it's a different daemon (by its ID) from the one
+#   the `Access` was worked out for.
+
+@dataclass(frozen=True)
+class Access:
+    ''' How we reach a Docker daemon, and what it supports. '''
+    docker_host : str               # $DOCKER_HOST this is for ('' if unset)
+    daemon_id   : str               # `ID` from ``docker info``
+    command     : tuple[str,...]    # `DOCKER_COMMAND`
+    engine      : bool              # we can use its socket directly
+    api_version : str
+    buildkit    : bool              # `docker build` can use BuildKit
+
+#   The current daemon's `Access`, once known.
+ACCESS:Access|None = None
+
+def access_cache() -> Path:
+    ' The file caching an `Access` for each ``$DOCKER_HOST``. '
+    return host_state() / 'docker-access.json'
+
+def load_access() -> Access|None:
+    ''' Return the cached `Access` for the current ``$DOCKER_HOST``,
+        if we have one.
+    '''
+    try:
+        entries = json.loads(access_cache().read_text())
+        entry = entries[os.environ.get('DOCKER_HOST', '')]
+        return Access(**(entry | { 'command': tuple(entry['command']) }))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_access(access:Access|None):
+    ''' Cache `access` for its ``$DOCKER_HOST`` or, if `None`, remove the
+        entry for the current ``$DOCKER_HOST``. The cache is best-effort:
+        failure to write it is ignored.
+    '''
+    path = access_cache()
+    try:
+        entries = json.loads(path.read_text())
+    except (OSError, ValueError):
+        entries = {}
+    if access is None:
+        if entries.pop(os.environ.get('DOCKER_HOST', ''), None) is None:
+            return
+    else:
+        entries[access.docker_host] = asdict(access)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}')
+        tmp.write_text(json.dumps(entries, indent=2) + '\n')
+        tmp.replace(path)
+    except OSError:
+        pass
+
+def forget_access():
+    ''' A daemon call failed; our cached `Access` may be why, so drop it
+        so that the next run works out access afresh.
+    '''
+    global ACCESS
+    if ACCESS is not None:
+        ACCESS = None
+        save_access(None)
+
+def same_daemon() -> bool:
+    ''' Whether we can still reach the daemon our `Access` describes, and
+        so a call that failed did so for reasons other than our `Access`.
+    '''
+    if ENGINE is not None:
+        try:
+            _, info = ENGINE.request('GET', '/info')
+        except (OSError, engine.EngineError):
+            return False
+        daemon_id = (info or {}).get('ID', '')
+    else:
+        proc = run(DOCKER_COMMAND + ('info', '--format={{.ID}}'),
+            stdout=PIPE, stderr=DEVNULL)
+        if proc.returncode != 0:  return False
+        daemon_id = proc.stdout.decode('UTF-8').strip()
+    return ACCESS is None or ACCESS.daemon_id == daemon_id
+
+def use_access(access:Access):
+    ' Set up to talk to the daemon as described by `access`. '
+    global ACCESS, DOCKER_COMMAND, ENGINE
+    ACCESS = access
+    DOCKER_COMMAND = access.command
+    path = engine.socket_path()
+    if access.engine and path is not None:
+        ENGINE = engine.Engine(path, access.api_version)
+
+def reset_access():
+    ' Forget how we talk to the daemon, so `docker_setup()` can start over. '
+    global ACCESS, DOCKER_COMMAND, ENGINE
+    if ENGINE is not None:  ENGINE.close()
+    ACCESS, DOCKER_COMMAND, ENGINE = None, ('docker',), None
+
+@trace.phase('probe_access')
+def probe_access(info_id:str|None=None) -> Access:
+    ''' Having set `ENGINE` and `DOCKER_COMMAND`, query the daemon for the
+        rest of an `Access` describing it and cache that. `info_id` is the
+        daemon ID if we already have it from ``docker info``.
+    '''
+    global ACCESS
+    if ENGINE is not None:
+        _, info = ENGINE.request('GET', '/info')
+        _, version = ENGINE.request('GET', '/version')
+        daemon_id = (info or {}).get('ID', '')
+        api_version = (version or {}).get('ApiVersion', '')
+    else:
+        daemon_id = info_id if info_id is not None \
+            else cli_output('info', '--format={{.ID}}')
+        api_version = cli_output('version', '--format={{.Server.APIVersion}}')
+    #   BuildKit is used by `docker build` only if the CLI has the buildx
+    #   plugin; this doesn't need the daemon.
+    buildkit = 0 == call(DOCKER_COMMAND + ('buildx', 'version'),
+        stdout=DEVNULL, stderr=DEVNULL)
+    ACCESS = Access(os.environ.get('DOCKER_HOST', ''), daemon_id,
+        DOCKER_COMMAND, ENGINE is not None, api_version, buildkit)
+    save_access(ACCESS)
+    return ACCESS
+
+def cli_output(*args:str) -> str:
+    ' Return the stripped stdout of ``docker *args``, ignoring errors. '
+    proc = run(DOCKER_COMMAND + args, stdout=PIPE, stderr=DEVNULL)
+    return proc.stdout.decode('UTF-8').strip()
+
+@trace.phase('docker_setup')
 def docker_setup():
-    ''' Determine whether we use ``docker`` or ``sudo docker``.
+    ''' Determine how we talk to the Docker daemon: directly through its
+        socket if we have access to it (setting `ENGINE`), and whether we
+        use ``docker`` or ``sudo docker`` for everything else. This is
+        taken from the cached `Access` if we have one.
 
         This does not honour ``--dry-run`` because 'query-state' docker
         commands are always run; only 'change-state' docker commands are
         echoed instead of run in dry-run mode.
     '''
-    global DOCKER_COMMAND
+    global ENGINE
 
-    retcode = call(DOCKER_COMMAND + ('info',), stdout=DEVNULL, stderr=DEVNULL)
-    if retcode == 0:
+    access = load_access()
+    if access is not None:
+        use_access(access)
+        return
+
+    #   If we can use the socket directly, so can a plain `docker` command,
+    #   and we need not spend a fork/exec of `docker info` finding that out.
+    ENGINE = engine.connect()
+    if ENGINE is not None:
+        probe_access()
+        return
+
+    info = run(DOCKER_COMMAND + ('info', '--format={{.ID}}'),
+        stdout=PIPE, stderr=DEVNULL)
+    setup_command(info.returncode)
+    probe_access(info.stdout.decode('UTF-8').strip() or None)
+
+def setup_command(info_retcode:int):
+    ''' Given the exit code of ``docker info``, decide whether we must
+        use ``sudo docker`` instead of ``docker``.
+    '''
+    global DOCKER_COMMAND
+    if info_retcode == 0:
         return
 
     #   Before we do any further work, ensure user can sudo and has
@@ -30,6 +199,78 @@ def docker_setup():
         die('Cannot run `docker` as this user and cannot sudo.')
     DOCKER_COMMAND = ('sudo',) + DOCKER_COMMAND
 
+@trace.phase('docker_setup_inspect')
+def docker_setup_inspect(object:str, name:str) -> dict[Any,Any]|None:
+    ''' Do `docker_setup()` and return `docker_inspect(object, name)`,
+        overlapping the two rather than doing them one after the other.
+
+        If the resident helper (see `dent.helper`) is running it answers
+        for containers, usually from its cache. Otherwise, with a cached
+        `Access`, or the daemon socket, the inspect itself
+        tells us whether we can talk to the daemon, so this takes a single
+        round trip. Otherwise ``docker info`` and ``docker inspect`` are
+        run concurrently; only if the former says we need ``sudo`` must we
+        inspect again.
+    '''
+    global ENGINE
+
+    if object == 'container':
+        reply = helper.query(name)
+        if reply is not None:
+            a = reply['access']
+            use_access(Access(**(a | { 'command': tuple(a['command']) })))
+            return reply['container']
+
+    access = load_access()
+    if access is not None:
+        use_access(access)
+        ok, result = try_inspect(object, name)
+        if ok:  return result
+        forget_access()
+        reset_access()
+
+    path = engine.socket_path()
+    if path is not None:
+        e = engine.Engine(path)
+        try:
+            result = e.inspect(object, name)
+            ENGINE = e
+            probe_access()
+            return result
+        except OSError:
+            e.close()
+        except engine.EngineError as err:
+            die(f'Cannot inspect {object} {name!r}: {err}')
+
+    command = DOCKER_COMMAND + (object, 'inspect', name)
+    with trace.command_span(command) as rec:
+        inspect = Popen(command, stdout=PIPE, stderr=DEVNULL)
+        info = run(DOCKER_COMMAND + ('info', '--format={{.ID}}'),
+            stdout=PIPE, stderr=DEVNULL)
+        output, _ = inspect.communicate()
+        rec['status'] = inspect.returncode
+    setup_command(info.returncode)
+    probe_access(info.stdout.decode('UTF-8').strip() or None)
+    if info.returncode == 0:
+        return parse_inspect(output)
+    return docker_inspect(object, name)
+
+def try_inspect(object:str, name:str) -> tuple[bool,dict[Any,Any]|None]:
+    ''' Inspect as `docker_inspect()` does, but return ``(False, None)``
+        rather than falling back or dieing if we could not talk to the
+        daemon, and ``(True, result)`` otherwise.
+    '''
+    if ENGINE is not None:
+        try:
+            return True, ENGINE.inspect(object, name)
+        except (OSError, engine.EngineError):
+            return False, None
+    proc = run(DOCKER_COMMAND + (object, 'inspect', name),
+        stdout=PIPE, stderr=PIPE)
+    if proc.returncode != 0 and b'No such' not in proc.stderr:
+        return False, None
+    return True, parse_inspect(proc.stdout)
+
 def docker_inspect(object:str, name:str) -> dict[Any,Any]|None:
     ''' Run ``docker `object` inspect `name```, where `object` is usually
         ``image`` or ``container``.
@@ -49,23 +290,210 @@ def docker_inspect(object:str, name:str) -> dict[Any,Any]|None:
         queries determines what state-changing Docker commands will or
         would be executed.
     '''
-    try:
-        command = DOCKER_COMMAND + (object, 'inspect', name)
-        #   Unfortunately, this produces `Error: No such ...` on stderr
-        #   when the image or container doesn't exist. We suppress stdout
-        #   to avoid this printing to the terminal, though this may make
-        #   debugging errors in this program more difficult.
-        output = check_output(command, stderr=DEVNULL)
-    except CalledProcessError as failed:
-        output = failed.output     # Still need to get stdout
+    def cli() -> dict[Any,Any]|None:
+        try:
+            command = DOCKER_COMMAND + (object, 'inspect', name)
+            #   Unfortunately, this produces `Error: No such ...` on stderr
+            #   when the image or container doesn't exist. We suppress
+            #   stdout to avoid this printing to the terminal, though this
+            #   may make debugging errors in this program more difficult.
+            output = check_output(command, stderr=DEVNULL)
+        except CalledProcessError as failed:
+            output = failed.output     # Still need to get stdout
+        return parse_inspect(output)
+    return engine_or_cli(f'inspect {object} {name!r}',
+        lambda e: e.inspect(object, name), cli)
+
+T = TypeVar('T')
+
+def engine_or_cli(what:str, query:Callable[[engine.Engine],T],
+        cli:Callable[[],T]) -> T:
+    ''' Return the result of `query` on `ENGINE` if we're using the
+        daemon's socket, otherwise, or if we lose the connection, of `cli`
+        (running ``docker`` commands). If the daemon refuses the query we
+        die with an error saying we cannot do `what`.
+    '''
+    global ENGINE
+    if ENGINE is not None:
+        try:
+            return query(ENGINE)
+        except OSError:
+            #   Lost the daemon connection (e.g., a proxy exited); the
+            #   `docker` command will produce a better error, if any.
+            ENGINE = None
+            forget_access()
+        except engine.EngineError as e:
+            #   Perhaps an API version too new for a different daemon.
+            if not same_daemon():  forget_access()
+            die(f'Cannot {what}: {e}')
+    return cli()
+
+def parse_inspect(output:bytes) -> dict[Any,Any]|None:
+    ''' Parse the output of ``docker inspect`` for a single object, which
+        is a list of that object if it exists, or an empty list if not.
+    '''
     l = json.loads(output.decode('UTF-8'))
     if len(l) == 0: return None
     else:           return l[0]
 
+def docker_container_names() -> list[str]:
+    ''' Return the names of all containers, running or not. Like
+        `docker_inspect()`, this is not affected by ``--dry-run``.
+    '''
+    #   The API gives names with a leading slash, and may give several for
+    #   a container (legacy links) of which the first is its own.
+    return engine_or_cli('list containers',
+        lambda e: [ c['Names'][0].lstrip('/')
+                    for c in e.containers() if c.get('Names') ],
+        lambda: cli_output('container', 'ls', '--all', '--format={{.Names}}')
+            .split())
+
+def docker_containers(labels:list[str], size:bool=False
+        ) -> list[dict[str,Any]]:
+    ''' Return the containers, running or not, having all of `labels`
+        (each ``name`` or ``name=value``), all from a single query to the
+        daemon. Each is a dict of its ``Name``, whether it's ``Running``,
+        its ``State`` (``running``, ``exited``, etc.), the ``Image`` it was
+        created from (as named when it was) and that image's ``ImageID``,
+        its ``Labels``, the Unix time it was ``Created``, the names of the
+        ``Volumes`` it mounts and, with `size`, the ``SizeRw`` of its
+        writable layer (else `None`). Like `docker_inspect()`, this is not
+        affected by ``--dry-run``. With no `labels`, all containers are
+        returned.
+    '''
+    def volumes(c:dict[str,Any]) -> list[str]:
+        return [ m['Name'] for m in c.get('Mounts') or ()
+                 if m.get('Type') == 'volume' and m.get('Name') ]
+    def query(e:engine.Engine) -> list[dict[str,Any]]:
+        return [ { 'Name':      c['Names'][0].lstrip('/'),
+                   'Running':   c.get('State') == 'running',
+                   'State':     c.get('State', ''),
+                   'Image':     c.get('Image', ''),
+                   'ImageID':   c.get('ImageID', ''),
+                   'Labels':    c.get('Labels') or {},
+                   'Created':   float(c.get('Created', 0)),
+                   'Volumes':   volumes(c),
+                   'SizeRw':    c.get('SizeRw'), }
+                 for c in e.containers({ 'label': labels }, size)
+                 if c.get('Names') ]
+    def cli() -> list[dict[str,Any]]:
+        #   `container ls` gives no labels or times we can use, so we get
+        #   the IDs and inspect them all at once.
+        ids = cli_output('container', 'ls', '--all', '--no-trunc',
+            *( '--filter=label=' + l for l in labels ),
+            '--format={{.ID}}').split()
+        if not ids:  return []
+        return [ { 'Name':      c['Name'].lstrip('/'),
+                   'Running':   c['State']['Running'],
+                   'State':     c['State'].get('Status', ''),
+                   'Image':     c['Config'].get('Image', ''),
+                   'ImageID':   c.get('Image', ''),
+                   'Labels':    c['Config'].get('Labels') or {},
+                   'Created':   unix_time(c.get('Created', '')),
+                   'Volumes':   volumes(c),
+                   'SizeRw':    c.get('SizeRw'), }
+                 for c in json.loads(cli_output('container', 'inspect',
+                    *(('--size',) if size else ()), *ids)) ]
+    return engine_or_cli('list containers', query, cli)
+
+def docker_container_changes(name:str) -> list[str]:
+    ''' Return the changes to the filesystem of container `name` since it
+        was created, each as ``docker container diff`` prints it: ``C``
+        (changed), ``A`` (added) or ``D`` (deleted), a space and the path.
+        Like `docker_inspect()`, this is not affected by ``--dry-run``.
+    '''
+    return engine_or_cli(f'list changes to container {name}',
+        lambda e: [ '{} {}'.format('CAD'[c['Kind']], c['Path'])
+                    for c in e.changes(name) ],
+        lambda: cli_output('container', 'diff', name).splitlines())
+
+def unix_time(timestamp:str) -> float:
+    ''' Return the Unix time of a Docker (RFC 3339, UTC) `timestamp`, to the
+        second, or 0 if it cannot be parsed.
+    '''
+    import  calendar, time
+    try:
+        return float(calendar.timegm(
+            time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')))
+    except ValueError:
+        return 0.0
+
+def docker_images(label:str, shared_size:bool=False) -> list[dict[str,Any]]:
+    ''' Return the images having `label` (``name`` or ``name=value``), each
+        as a dict of its ``Id``, ``RepoTags`` (possibly empty), ``Labels``,
+        the Unix time it was ``Created``, its ``Size`` and, with
+        `shared_size`, its ``SharedSize``: the bytes of its layers that
+        other images also use (`None` if the daemon can't tell us). Like
+        `docker_inspect()`, this is not affected by ``--dry-run``.
+    '''
+    def cli() -> list[dict[str,Any]]:
+        #   `image ls` gives an image once for each tag, and not its labels.
+        ids = dict.fromkeys(cli_output('image', 'ls', '--no-trunc',
+            '--filter=label='+label, '--format={{.ID}}').split())
+        images = json.loads(cli_output('image', 'inspect', *ids)) \
+            if ids else []
+        for i in images:
+            i['Labels'] = (i.get('Config') or {}).get('Labels')
+            i['Created'] = unix_time(i.get('Created', ''))
+        return images
+    images = engine_or_cli('list images',
+        lambda e: e.images({ 'label': [label] }, shared_size), cli)
+    return [ { 'Id':        i['Id'],
+               'RepoTags':  [ t for t in i.get('RepoTags') or ()
+                              if t != '<none>:<none>' ],
+               'Labels':    i.get('Labels') or {},
+               'Created':   float(i.get('Created', 0)),
+               'Size':      i.get('Size', 0),
+               'SharedSize': i['SharedSize']
+                             if i.get('SharedSize', -1) >= 0 else None, }
+             for i in images ]
+
+def docker_volumes(labels:list[str]) -> list[dict[str,Any]]:
+    ''' Return the volumes having all of `labels` (each ``name`` or
+        ``name=value``), each as a dict of its ``Name``, ``Labels``, the
+        Unix time it was ``Created`` and its ``Size`` (`None` if the daemon
+        can't tell us). Like `docker_inspect()`, this is not affected by
+        ``--dry-run``.
+    '''
+    def cli() -> list[dict[str,Any]]:
+        #   `volume ls` gives no times, and neither gives sizes.
+        names = cli_output('volume', 'ls',
+            *( '--filter=label=' + l for l in labels ),
+            '--format={{.Name}}').split()
+        return json.loads(cli_output('volume', 'inspect', *names)) \
+            if names else []
+    #   Only the disk usage query gives sizes, and it can't filter.
+    volumes = engine_or_cli('list volumes', lambda e: e.volumes(), cli)
+    return [ { 'Name':      v['Name'],
+               'Labels':    v.get('Labels') or {},
+               'Created':   unix_time(v.get('CreatedAt', '')),
+               'Size':      size if size >= 0 else None, }
+             for v in volumes if has_labels(v.get('Labels') or {}, labels)
+             for size in [(v.get('UsageData') or {}).get('Size', -1)] ]
+
+def has_labels(have:dict[str,str], labels:list[str]) -> bool:
+    ''' Whether `have` includes all of `labels` (each ``name`` or
+        ``name=value``), as the daemon's label filters test it.
+    '''
+    for l in labels:
+        k, eq, v = l.partition('=')
+        if k not in have or (eq and have[k] != v):
+            return False
+    return True
+
+@trace.phase('docker_container_start')
 def docker_container_start(conf:Config):
     ''' Run `docker container start` on the arguments.
     '''
     qprint(conf.quiet, "Starting container '{}'".format(conf.CONTAINER_NAME))
+    if ENGINE is not None and not conf.dry_run:
+        try:
+            ENGINE.start(conf.CONTAINER_NAME)
+            return None
+        except engine.EngineError as e:
+            die(f"Couldn't start container: {e}")
+        except OSError:
+            pass            # Fall back to the `docker` command.
     command = DOCKER_COMMAND + ('container', 'start', conf.CONTAINER_NAME)
     #   Suppress stdout because `docker` prints the names
     #   of the containers it started.
@@ -74,11 +502,44 @@ def docker_container_start(conf:Config):
         die("Couldn't start container")
     return None
 
-def drcall(conf:Config, command, **kwargs):
+#   The container lifecycle events `docker_container_events()` reports.
+CONTAINER_EVENTS = ['start', 'die', 'destroy']
+
+def docker_container_events(name:str, since:float, until:float
+        ) -> Iterator[str]:
+    ''' Yield the action (one of `CONTAINER_EVENTS`) of each lifecycle
+        event for container `name` from Unix time `since`, which may be
+        in the past, until `until`.
+
+        Like `docker_inspect()`, this is a query and so is not affected by
+        ``--dry-run``.
+    '''
+    filters = { 'type': ['container'], 'container': [name],
+                'event': CONTAINER_EVENTS }
+    if ENGINE is not None:
+        try:
+            for event in ENGINE.events(filters, since, until):
+                yield event.get('Action', '')
+            return
+        except (OSError, engine.EngineError):
+            pass            # Fall back to the `docker` command.
+    command = DOCKER_COMMAND + ('events', '--format={{json .}}',
+        f'--since={since:.9f}', f'--until={until:.9f}',
+        *( f'--filter={k}={v}' for k, vs in filters.items() for v in vs ))
+    with trace.command_span(command), \
+            Popen(command, stdout=PIPE, stderr=DEVNULL) as proc:
+        try:
+            for line in proc.stdout or ():
+                if line.strip():  yield json.loads(line).get('Action', '')
+        finally:
+            proc.kill()
+
+def drcall(conf:Config, command, input:bytes|None=None, **kwargs):
     ''' Execute the `command` with `**kwargs` just as `subprocess.call()`
         would unless we're doing a ``--dry-run``, in which case just print
         `command` to `stderr` and return success. (Thus this should not be
-        used for gathering information, only for changing state.)
+        used for gathering information, only for changing state.) If
+        `input` is given, it's written to the command's stdin.
 
         This uses stderr rather than stdout becuase user messages are
         already going to `stdout` and so this allows more easily separating
@@ -86,7 +547,17 @@ def drcall(conf:Config, command, **kwargs):
         should appear on stderr.)
     '''
     if not conf.dry_run:
-        return call(command, **kwargs)
+        if input is None:
+            retcode = call(command, **kwargs)
+        else:
+            retcode = run(command, input=input, **kwargs).returncode
+        #   Commands fail for many reasons (an image in use, a bad `-r`
+        #   option); only not reaching the daemon, or reaching a different
+        #   one, says our access is wrong.
+        if retcode != 0 and tuple(command[:len(DOCKER_COMMAND)]) \
+                == DOCKER_COMMAND and not same_daemon():
+            forget_access()
+        return retcode
     else:
         #   Ensure we're not coming out before stuff that's been buffered
         #   but not yet printed (many systems buffer stdout but not stderr).
@@ -0,0 +1,421 @@
+''' dent.engine - Docker Engine API client over the daemon's Unix socket
+
+    This speaks HTTP/1.1 directly to the socket on which the Docker daemon
+    (or a proxy to it, such as the one started by ``dockerd-proxy``)
+    listens. For state queries this saves the fork/exec and Go runtime
+    start-up of a ``docker`` command each time, and it lets us keep a
+    single keep-alive connection open for all the queries a Dent process
+    makes.
+
+    Only Unix-domain sockets are supported; for ``tcp://`` or ``ssh://``
+    daemons, or when a non-default Docker CLI context is selected,
+    `socket_path()` returns `None` and the caller should fall back to the
+    ``docker`` command, which knows how to deal with those.
+'''
+
+from    collections.abc  import Iterator
+from    contextlib  import contextmanager
+from    pathlib  import Path
+from    typing  import Any, BinaryIO
+from    urllib.parse  import quote, urlencode
+import  json, os, socket, threading, time
+
+from    dent  import trace
+
+#   What the ``docker`` command uses when $DOCKER_HOST is not set. (On most
+#   current systems this is a symlink to /run/docker.sock.)
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+class EngineError(Exception):
+    ''' The daemon returned an unexpected HTTP status. The daemon's error
+        message, if any, is the exception message.
+    '''
+    def __init__(self, status:int, message:str):
+        super().__init__(f'{message} (HTTP status {status})')
+        self.status = status
+
+def socket_path(environ=None) -> str|None:
+    ''' Return the path to the Docker daemon socket the ``docker`` command
+        would use, or `None` if it would use something we don't handle.
+    '''
+    if environ is None:  environ = os.environ
+    if environ.get('DOCKER_CONTEXT', 'default') != 'default':
+        return None
+    host = environ.get('DOCKER_HOST')
+    if host:
+        if host.startswith('unix://'):
+            return host[len('unix://'):]
+        return None
+    #   `docker context use` saves the selected context in the CLI config.
+    config = Path(environ.get('DOCKER_CONFIG') or Path.home()/'.docker')
+    try:
+        cur = json.loads((config/'config.json').read_text()) \
+            .get('currentContext')
+    except (OSError, ValueError, AttributeError):
+        cur = None
+    if cur not in (None, '', 'default'):
+        return None
+    return DEFAULT_SOCKET
+
+####################################################################
+#   HTTP/1.1 over a Unix socket
+#
+#   We don't use `http.client`: importing it (and the `email` and `ssl`
+#   packages it brings in) takes longer than Dent's entire round trip
+#   to the daemon, and we need only the little of HTTP the daemon uses.
+
+class ProtocolError(ConnectionError):
+    ' The daemon sent something we cannot parse as an HTTP response. '
+
+class Connection:
+    ''' An HTTP/1.1 client connection to the Unix-domain socket at
+        `sockpath`, connected on first use and kept alive between requests
+        unless the server closes it.
+    '''
+
+    def __init__(self, sockpath:str, timeout:float|None=None,
+            buffered:bool=True):
+        self.sockpath = sockpath
+        self.timeout = timeout
+        self.buffered = buffered
+        self.sock:socket.socket|None = None
+        self.rfile:BinaryIO|None = None
+
+    def close(self):
+        if self.rfile is not None:  self.rfile.close()
+        if self.sock is not None:   self.sock.close()
+        self.sock = self.rfile = None
+
+    def request(self, method:str, url:str, body:bytes|None=None,
+            headers:dict[str,str]={}) -> 'Response':
+        ''' Send a request and read the response status and headers. The
+            body must be read from the `Response` before the next request.
+        '''
+        if self.sock is None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.settimeout(self.timeout)
+                s.connect(self.sockpath)
+            except OSError:
+                s.close()
+                raise
+            self.sock = s
+            self.rfile = s.makefile('rb') if self.buffered \
+                else s.makefile('rb', buffering=0)  # type: ignore[assignment]
+        assert self.rfile is not None
+        head = [ f'{method} {url} HTTP/1.1', 'Host: docker' ]
+        head += [ f'{k}: {v}' for k, v in headers.items() ]
+        if body is not None or method in ('POST', 'PUT'):
+            head.append(f'Content-Length: {len(body or b"")}')
+        self.sock.sendall(
+            ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        return Response(self.rfile, method)
+
+class Response:
+    ''' The response to a request: `status`, `headers` (with lower-case
+        names) and a body that can be read all at once with `read()` or
+        line by line, as it arrives, by iterating over this.
+    '''
+
+    def __init__(self, rfile:BinaryIO, method:str):
+        self.rfile = rfile
+        line = rfile.readline(65537)
+        if not line:
+            #   Usually a kept-alive connection the daemon since closed.
+            raise ProtocolError('connection closed by daemon')
+        try:
+            _version, status, *_ = line.split(None, 2)
+            self.status = int(status)
+        except ValueError:
+            raise ProtocolError(f'bad HTTP status line {line!r}') from None
+        self.headers:dict[str,str] = {}
+        while (line := rfile.readline(65537)) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+
+        self.chunked = 'chunked' in self.headers.get('transfer-encoding', '')
+        self.length:int|None = None
+        if method == 'HEAD' or self.status in (204, 304) or self.status < 200:
+            self.length = 0
+        elif not self.chunked and 'content-length' in self.headers:
+            self.length = int(self.headers['content-length'])
+        self.will_close = self.headers.get('connection', '').lower() \
+            == 'close' or (not self.chunked and self.length is None)
+
+    def getheader(self, name:str) -> str|None:
+        return self.headers.get(name.lower())
+
+    def chunks(self) -> Iterator[bytes]:
+        ' Yield the body in pieces as it arrives. '
+        if self.chunked:
+            while True:
+                line = self.rfile.readline(1026)
+                try:
+                    size = int(line.split(b';')[0], 16)
+                except ValueError:
+                    raise ProtocolError('connection closed in response body'
+                        if not line else f'bad chunk size line: {line!r}')
+                if size == 0:
+                    while self.rfile.readline(65537) not in (b'\r\n', b''):
+                        pass    # trailers
+                    return
+                yield self.read_exactly(size)
+                self.rfile.readline(3)      # CRLF ending the chunk
+        elif self.length is not None:
+            if self.length > 0:  yield self.read_exactly(self.length)
+        else:
+            while (data := self.rfile.read1(65536)):    # type: ignore[attr-defined]
+                yield data
+
+    def read_exactly(self, size:int) -> bytes:
+        data = self.rfile.read(size)
+        if len(data) != size:
+            raise ProtocolError('connection closed in response body')
+        return data
+
+    def read(self) -> bytes:
+        return b''.join(self.chunks())
+
+    def __iter__(self) -> Iterator[bytes]:
+        ' Yield the body line by line as it arrives. '
+        partial = b''
+        for chunk in self.chunks():
+            *lines, partial = (partial + chunk).split(b'\n')
+            for line in lines:  yield line + b'\n'
+        if partial:  yield partial
+
+####################################################################
+#   Engine API
+
+class Engine:
+    ''' A client for the Docker Engine API on the socket at `sockpath`.
+
+        Requests are made over a single persistent connection that is
+        reconnected as necessary; requests from multiple threads are
+        made on it one at a time. Streaming requests (which tie up a
+        connection until the stream ends) must use `stream()`, which
+        uses a separate connection.
+
+        Errors connecting to or talking to the daemon raise `OSError`
+        (including `ProtocolError`).
+    '''
+
+    def __init__(self, sockpath:str, api_version:str|None=None):
+        self.sockpath = sockpath
+        self.conn = Connection(sockpath)
+        self.lock = threading.Lock()
+        #   Without a version the daemon uses its latest API version.
+        self.prefix = f'/v{api_version}' if api_version else ''
+
+    def close(self):
+        self.conn.close()
+
+    def request(self, method:str, path:str, query:dict|None=None,
+            body:Any=None) -> tuple[int,Any]:
+        ''' Make a request, returning the HTTP status and the body parsed
+            from JSON (or `None` if the body is empty or not JSON).
+
+            A ``GET`` request on a kept-alive connection that the daemon
+            has since closed is retried once on a new connection.
+        '''
+        url = self.prefix + path + ('?' + urlencode(query) if query else '')
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('UTF-8')
+            headers['Content-Type'] = 'application/json'
+        with self.lock, trace.span('request', f'{method} {path}') as rec:
+            retry = method == 'GET' and self.conn.sock is not None
+            while True:
+                try:
+                    resp = self.conn.request(method, url, data, headers)
+                    content = resp.read()
+                    if resp.will_close:  self.conn.close()
+                    break
+                except ConnectionError:
+                    self.conn.close()
+                    if not retry:  raise
+                    retry = False
+            rec['status'] = resp.status
+        return resp.status, parse_body(resp, content)
+
+    @contextmanager
+    def stream(self, method:str, path:str, query:dict|None=None,
+            timeout:float|None=None) -> Iterator[Response]:
+        ''' Make a request on a new connection, yielding the response for
+            the caller to read as the body arrives. The connection is
+            closed when the context exits.
+        '''
+        url = self.prefix + path + ('?' + urlencode(query) if query else '')
+        conn = Connection(self.sockpath, timeout=timeout)
+        try:
+            yield conn.request(method, url)
+        finally:
+            conn.close()
+
+    def hijack(self, method:str, path:str, body:Any) -> socket.socket:
+        ''' Make a request (with a JSON `body`) on a new connection that the
+            daemon takes over for a raw stream once it has sent the
+            response headers, as for starting an exec, returning the socket
+            for the caller to use and close.
+        '''
+        #   Unbuffered, so that no more than the response headers are read.
+        conn = Connection(self.sockpath, buffered=False)
+        try:
+            with trace.span('request', f'{method} {path}') as rec:
+                resp = conn.request(method, self.prefix + path,
+                    json.dumps(body).encode('UTF-8'),
+                    { 'Content-Type': 'application/json',
+                      'Connection': 'Upgrade', 'Upgrade': 'tcp' })
+                rec['status'] = resp.status
+            if resp.status not in (101, 200):
+                check(resp.status, parse_body(resp, resp.read()))
+        except BaseException:
+            conn.close()
+            raise
+        assert conn.sock is not None and conn.rfile is not None
+        conn.rfile.close()          # leaving the socket open
+        return conn.sock
+
+    def exec_create(self, name:str, cmd:list[str], env:list[str]) -> str:
+        ''' Create an exec instance running `cmd` in container `name` with
+            the ``NAME=value`` environment settings `env`, and its standard
+            input, output and error attached, returning its ID.
+        '''
+        status, body = self.request('POST',
+            '/containers/{}/exec'.format(quote(name, safe='')), body={
+                'AttachStdin': True, 'AttachStdout': True,
+                'AttachStderr': True, 'Tty': False, 'Cmd': cmd, 'Env': env, })
+        check(status, body)
+        return body['Id']
+
+    def exec_start(self, id:str) -> socket.socket:
+        ''' Start exec instance `id`, returning the socket carrying its
+            input and (multiplexed, see `dent.stream`) output.
+        '''
+        return self.hijack('POST', f'/exec/{id}/start',
+            { 'Detach': False, 'Tty': False })
+
+    def ping(self) -> bool:
+        ' Confirm the daemon is answering requests. '
+        status, _ = self.request('GET', '/_ping')
+        return status == 200
+
+    def inspect(self, object:str, name:str) -> dict[Any,Any]|None:
+        ''' Return the inspect data for the container, image or exec
+            instance (`object`) `name`, exactly as ``docker inspect`` would
+            give it, or `None` if there is no such object.
+        '''
+        path = { 'container': '/containers/{}/json',
+                 'image':     '/images/{}/json',
+                 'exec':      '/exec/{}/json', }[object]
+        status, body = self.request('GET',
+            path.format(quote(name, safe='/:')))
+        if status == 404:   return None
+        check(status, body)
+        return body
+
+    def containers(self, filters:dict[str,list[str]]|None=None,
+            size:bool=False) -> list[dict[str,Any]]:
+        ''' Return the summaries of all containers, running or not, or
+            those matching `filters`. With `size`, these include the
+            ``SizeRw`` of each, which the daemon must work out.
+        '''
+        query = { 'all': '1' }
+        if filters:  query['filters'] = json.dumps(filters)
+        if size:  query['size'] = '1'
+        status, body = self.request('GET', '/containers/json', query)
+        check(status, body)
+        return body
+
+    def changes(self, name:str) -> list[dict[str,Any]]:
+        ''' Return the changes to the filesystem of container `name` since
+            it was created, each a ``Path`` and its ``Kind`` (0: modified,
+            1: added, 2: deleted).
+        '''
+        status, body = self.request('GET',
+            '/containers/{}/changes'.format(quote(name, safe='')))
+        check(status, body)
+        return body or []
+
+    def images(self, filters:dict[str,list[str]], shared_size:bool=False
+            ) -> list[dict[str,Any]]:
+        ''' Return the summaries of the images matching `filters`. With
+            `shared_size`, each one's ``SharedSize`` (the bytes of its
+            layers that other images also use) is worked out; otherwise
+            it's -1.
+        '''
+        query = { 'filters': json.dumps(filters) }
+        if shared_size:  query['shared-size'] = '1'
+        status, body = self.request('GET', '/images/json', query)
+        check(status, body)
+        return body
+
+    def volumes(self) -> list[dict[str,Any]]:
+        ''' Return the summaries of all volumes, each with the ``Size`` in
+            its ``UsageData`` (-1 if the daemon can't tell), which the
+            daemon must work out by walking the volume.
+        '''
+        status, body = self.request('GET', '/system/df',
+            { 'type': 'volume' })
+        check(status, body)
+        return body.get('Volumes') or []
+
+    def start(self, name:str):
+        ''' Start container `name`. The daemon does not reply until the
+            container's process has been started (or has failed to start).
+        '''
+        status, body = self.request('POST',
+            '/containers/{}/start'.format(quote(name, safe='')))
+        check(status, body, ok=(204, 304))     # 304: already started
+
+    def events(self, filters:dict[str,list[str]], since:float,
+            until:float|None) -> Iterator[dict[str,Any]]:
+        ''' Yield the daemon's events matching `filters` from Unix time
+            `since` (which may be in the past) until `until`, or for as
+            long as the daemon keeps the connection open if that's `None`.
+            Events up to the time of the call are delivered immediately,
+            subsequent ones as they happen.
+        '''
+        query = { 'since': f'{since:.9f}', 'filters': json.dumps(filters) }
+        timeout = None
+        if until is not None:
+            query['until'] = f'{until:.9f}'
+            timeout = max(until - time.time(), 0.001)
+        with trace.span('request', 'GET /events'), \
+                self.stream('GET', '/events', query, timeout=timeout) as resp:
+            check(resp.status, None)
+            try:
+                for line in resp:
+                    if line.strip():  yield json.loads(line)
+            except TimeoutError:
+                pass
+
+def parse_body(resp:Response, content:bytes) -> Any:
+    if not content:  return None
+    ctype = resp.getheader('Content-Type') or ''
+    if not ctype.startswith('application/json'):  return None
+    return json.loads(content.decode('UTF-8'))
+
+def check(status:int, body:Any, ok=(200, 201, 204)):
+    ''' Raise an `EngineError` for an HTTP `status` not in `ok`, using the
+        error message from the response `body`.
+    '''
+    if status in ok:  return
+    message = body.get('message') if isinstance(body, dict) else None
+    raise EngineError(status, message or 'Docker daemon request failed')
+
+def connect(environ=None) -> Engine|None:
+    ''' Return an `Engine` connected to the daemon the ``docker`` command
+        would use, or `None` if we cannot connect to it ourselves (no such
+        socket, no permission to use it, or not a Unix socket at all).
+    '''
+    path = socket_path(environ)
+    if path is None:  return None
+    engine = Engine(path)
+    try:
+        if engine.ping():  return engine
+    except OSError:
+        pass
+    engine.close()
+    return None
@@ -0,0 +1,234 @@
+''' dent.garbage - remove the images, containers, shares and caches nothing uses
+
+    ``dent --gc`` looks for four kinds of the user's garbage:
+
+    - *images*: those Dent built that are stale (see
+      `dent.image.cached_images()`), and untagged images superseded by a
+      tagged one built from the same context, as ``-R`` leaves them once
+      the containers using them are gone;
+    - *containers*: pooled containers that are stopped or whose image has
+      been rebuilt, which will never be claimed;
+    - *shares*: Dent shares whose containers no longer exist;
+    - *caches*: cache volumes (see ``-C``) that no container mounts.
+
+    These all come from a few bulk queries of the daemon (the images, with
+    the space each shares with others, all containers, the pooled
+    containers with their sizes, and the cache volumes with theirs) and a
+    single walk of the directory holding the shares. Of these, whatever no
+    container uses and is older than the age limit is removed, except for
+    the newest few images for each base image and tag.
+'''
+
+from    collections  import defaultdict
+from    dataclasses  import dataclass
+from    pathlib  import Path
+from    subprocess  import DEVNULL
+import  os, time
+
+from    dent  import docker, image, pool
+from    dent.configure  import Config
+from    dent.container  import CACHE_LABEL, share_source
+from    dent.image  import (
+        BASE_LABEL, HASH_LABEL, REFRESH_LABEL, STAGE_LABEL, TAG_LABEL,
+        short_id)
+from    dent.inventory  import age, size
+from    dent.util  import PWENT, qprint, state_home
+
+KINDS = ('images', 'containers', 'shares', 'caches')
+
+@dataclass
+class Garbage:
+    ''' Something unused, which removing would free `bytes` of disk space
+        (as far as we can tell), last created or changed at Unix `time`.
+    '''
+    kind    : str                   # one of `KINDS`
+    name    : str
+    bytes   : int
+    time    : float
+    why     : str
+    group   : str = ''              # of images, for the keep policy
+    command : tuple[str,...] = ()   # the ``docker`` args removing it
+    paths   : tuple[Path,...] = ()  # and files to remove
+    volumes : tuple[str,...] = ()   # and volumes to remove
+
+def collect(conf:Config, max_age:float, keep:int, now:float|None=None
+        ) -> int:
+    ''' Remove the garbage at least `max_age` seconds old, except for the
+        newest `keep` images of each base image and tag, and print how
+        much space each kind freed. Return 1 if anything could not be
+        removed (usually because something started using it), else 0.
+    '''
+    if now is None:  now = time.time()
+    found = find_garbage()
+    chosen = select(found, max_age, keep, now)
+    failed = 0
+    containers = [ g for g in chosen if g.kind == 'containers' ]
+    for g in chosen:
+        qprint(conf.quiet, 'Removing {} {} ({}, {}, {})'.format(
+            g.kind[:-1], g.name, g.why, size(g.bytes), age(now, g.time)))
+    #   Containers first, so that their images and volumes may go too.
+    if containers and docker.drcall(conf, docker.DOCKER_COMMAND + ('rm',
+            '--force', *(g.name for g in containers)), stdout=DEVNULL):
+        failed += 1
+    for g in chosen:
+        if g.kind == 'images' and docker.drcall(conf,
+                docker.DOCKER_COMMAND + g.command, stdout=DEVNULL):
+            failed += 1
+    volumes = [ v for g in chosen for v in g.volumes ]
+    if volumes and docker.drcall(conf, docker.DOCKER_COMMAND + ('volume',
+            'rm', *volumes), stdout=DEVNULL):
+        failed += 1
+    paths = [ str(p) for g in chosen for p in g.paths ]
+    if paths and docker.drcall(conf, ('rm', '-rf', '--', *paths)):
+        failed += 1
+    print_summary(found, chosen)
+    return 1 if failed else 0
+
+def print_summary(found:list[Garbage], chosen:list[Garbage]):
+    ''' Print, for each kind, how many were found unused and removed, and
+        the space removing them freed. This is our output and so is
+        printed even with ``--quiet``.
+    '''
+    rows = [ ('KIND', 'UNUSED', 'REMOVED', 'FREED') ]
+    for kind in KINDS:
+        removed = [ g for g in chosen if g.kind == kind ]
+        rows.append((kind, str(sum(g.kind == kind for g in found)),
+            str(len(removed)), size(sum(g.bytes for g in removed))))
+    rows.append(('total', str(len(found)), str(len(chosen)),
+        size(sum(g.bytes for g in chosen))))
+    for r in rows:
+        print('{:<10} {:>6} {:>7} {:>8}'.format(*r))
+
+def select(found:list[Garbage], max_age:float, keep:int, now:float
+        ) -> list[Garbage]:
+    ''' The garbage in `found` at least `max_age` seconds old, less the
+        newest `keep` images of each group.
+    '''
+    kept:dict[str,int] = defaultdict(int)
+    chosen = set()
+    for g in sorted(found, key=lambda g: -g.time):
+        if g.kind == 'images' and kept[g.group] < keep:
+            kept[g.group] += 1
+        elif now - g.time >= max_age:
+            chosen.add(id(g))
+    #   In the order found, which removes users' images before the
+    #   package images they're built on.
+    return [ g for g in found if id(g) in chosen ]
+
+def find_garbage() -> list[Garbage]:
+    ' All the user\'s unused images, pooled containers, shares and caches. '
+    containers = docker.docker_containers([])
+    used = { c['ImageID'] for c in containers }
+    shares = share_usage(state_home() / 'dent')
+    return unused_containers(shares) + unused_images(used) \
+        + unused_shares({ c['Name'] for c in containers }, shares) \
+        + unused_caches({ v for c in containers for v in c['Volumes'] })
+
+def unused_images(used:set[str]) -> list[Garbage]:
+    ''' The images from `cached_images()` that are stale, or superseded by
+        a tagged image built from the same context, and whose IDs are not
+        in `used`. Each frees the space it does not share with other images
+        (or, where the daemon can't tell us that, its whole size).
+    '''
+    images = image.cached_images(shared_size=True)
+    #   Tagged images by context hash and whether they're refreshes.
+    tagged = { (i['Labels'].get(HASH_LABEL), REFRESH_LABEL in i['Labels'])
+               for i, _ in images if i['RepoTags'] }
+    found = []
+    for i, state in reversed(images):
+        labels = i['Labels']
+        if i['Id'] in used:  continue
+        if state == 'stale':
+            why = 'stale'
+        elif not i['RepoTags'] and state == 'current' and (
+                labels.get(HASH_LABEL), REFRESH_LABEL in labels) in tagged:
+            why = 'superseded'
+        else:
+            continue
+        found.append(Garbage('images',
+            '{} {}'.format(short_id(i['Id']), ' '.join(i['RepoTags'])
+                or '<none>'),
+            i['Size'] - (i['SharedSize'] or 0), i['Created'], why,
+            group='{} {}'.format(labels.get(BASE_LABEL, ''),
+                'pkg' if labels.get(STAGE_LABEL) == 'pkg'
+                else labels.get(TAG_LABEL)),
+            #   As for `prune_image_cache()`.
+            command=('image', 'rm', *(i['RepoTags'] or [i['Id']]))))
+    return found
+
+def unused_containers(shares:dict[str,tuple[int,float]]) -> list[Garbage]:
+    ''' The user's pooled containers that are stopped or whose image has
+        been rebuilt, with their shares (whose sizes are in `shares`).
+    '''
+    current:dict[str,str|None] = {}
+    found = []
+    for c in docker.docker_containers(
+            [pool.POOL_LABEL, f'{image.USER_LABEL}={PWENT.pw_name}'],
+            size=True):
+        if not c['Name'].startswith(pool.POOL_PREFIX):  continue
+        pooled = c['Labels'].get(pool.POOL_LABEL, '')
+        if pooled not in current:
+            i = docker.docker_inspect('image', pooled)
+            current[pooled] = None if i is None else i['Id']
+        if not c['Running']:
+            why = 'stopped'
+        elif c['ImageID'] != current[pooled]:
+            why = 'image rebuilt'
+        else:
+            continue
+        share, (bytes, _) = pool.pool_share(c['Name']), \
+            shares.get('.pool/' + c['Name'], (0, 0.0))
+        found.append(Garbage('containers', c['Name'],
+            (c['SizeRw'] or 0) + bytes, c['Created'], why, paths=(share,)))
+    return found
+
+def unused_shares(names:set[str], shares:dict[str,tuple[int,float]]
+        ) -> list[Garbage]:
+    ''' The shares in `shares` (see `share_usage()`) whose containers are
+        not among the existing container `names`. A claimed pooled
+        container's share is a symlink to a share in ``.pool/``, which is
+        used while the symlink is.
+    '''
+    root = state_home() / 'dent'
+    used = { k for k in shares if k.removeprefix('.pool/') in names }
+    for k in list(used):
+        used.add(os.path.relpath(share_source(root / k), root))
+    return [ Garbage('shares', k, bytes, mtime, 'container gone',
+                     paths=(root / k,))
+             for k, (bytes, mtime) in shares.items() if k not in used ]
+
+def unused_caches(mounted:set[str]) -> list[Garbage]:
+    ''' The user's cache volumes not among the `mounted` volumes. Their
+        time is when they were created: the daemon doesn't record when a
+        volume was last used.
+    '''
+    return [ Garbage('caches', v['Name'], v['Size'] or 0, v['Created'],
+                     'not mounted', volumes=(v['Name'],))
+             for v in docker.docker_volumes(
+                [CACHE_LABEL, f'{image.USER_LABEL}={PWENT.pw_name}'])
+             if v['Name'] not in mounted ]
+
+def share_usage(root:Path) -> dict[str,tuple[int,float]]:
+    ''' Walk `root`, the directory holding the Dent shares, once, returning
+        for each share (``NAME``, or ``.pool/NAME`` for a pooled container)
+        the bytes of disk its files use and the latest time anything in it
+        was changed. Dent's own state in ``.host`` is not included.
+    '''
+    usage:dict[str,tuple[int,float]] = {}
+    for dir, dirs, files in os.walk(root):
+        rel = Path(dir).relative_to(root).parts
+        if not rel:
+            #   Container names can't start with `.`.
+            dirs[:] = [ d for d in dirs if d == '.pool' or d[0] != '.' ]
+            files = [ f for f in files if f[0] != '.' ]
+        for name in dirs + files:
+            parts = rel + (name,)
+            if parts == ('.pool',):  continue
+            key = '/'.join(parts[:2] if parts[0] == '.pool' else parts[:1])
+            try:
+                st = os.lstat(os.path.join(dir, name))
+            except OSError:
+                continue
+            bytes, mtime = usage.get(key, (0, 0.0))
+            usage[key] = (bytes + st.st_blocks * 512, max(mtime, st.st_mtime))
+    return usage
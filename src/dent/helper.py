@@ -0,0 +1,188 @@
+''' dent.helper - optional resident helper keeping daemon state at hand
+
+    ``dent --helper`` runs a per-user server on a Unix socket (see
+    `socket_path()`) that holds what each Dent run would otherwise work
+    out afresh: the daemon `dent.docker.Access` and connection, and the
+    inspect data of the containers asked about. The latter is cached for
+    as long as the helper is watching the daemon's event stream, and
+    dropped on any event that might change it.
+
+    When entering a container, `dent.docker.docker_setup_inspect()` first
+    asks the helper, with `query()`; if there is no helper, or it cannot
+    answer quickly, Dent carries on as it would without one.
+
+    The protocol is a line of JSON in each direction per connection: a
+    request ``{"env": ENV, "inspect": NAME}`` giving the client's Docker
+    environment variables and container name, and the reply ``{"access":
+    ACCESS, "container": INSPECT}`` or, if the helper cannot answer for
+    that environment, ``{}``.
+
+    This module is imported on every container entry, so the server
+    side imports what it needs only when it's run.
+'''
+
+from    pathlib  import Path
+from    typing  import Any
+import  json, os, socket, threading, time
+
+from    dent  import trace
+from    dent.util  import host_state
+
+#   The client's environment variables that select the daemon. The helper
+#   answers only clients for the same daemon as its own.
+DOCKER_ENV = ('DOCKER_HOST', 'DOCKER_CONTEXT', 'DOCKER_CONFIG')
+
+#   Seconds a client waits for the helper before giving up on it.
+QUERY_TIMEOUT = 0.5
+
+def socket_path() -> Path:
+    ''' The helper's socket: in ``$XDG_RUNTIME_DIR`` if set, as that's
+        private to the user and removed at logout, otherwise in Dent's host
+        state dir.
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:  return Path(runtime) / 'dent-helper.sock'
+    return host_state() / 'helper.sock'
+
+def docker_env(environ=None) -> dict[str,str]:
+    if environ is None:  environ = os.environ
+    return { k: environ.get(k, '') for k in DOCKER_ENV }
+
+def query(name:str) -> dict[str,Any]|None:
+    ''' Ask the helper for the daemon access and inspect data of container
+        `name`, returning the reply, or `None` if there's no helper or it
+        didn't answer.
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with s, trace.span('request', 'helper') as rec:
+        try:
+            s.settimeout(QUERY_TIMEOUT)
+            s.connect(str(socket_path()))
+            s.sendall(json.dumps({ 'env': docker_env(),
+                'inspect': name }).encode('UTF-8') + b'\n')
+            reply = json.loads(s.makefile('rb').readline())
+        except (OSError, ValueError):
+            rec['status'] = 'absent'
+            return None
+        if not reply:
+            rec['status'] = 'declined'
+            return None
+        return reply
+
+class Cache:
+    ''' Container inspect data from `inspect(name)`, kept only while
+        `watching` the daemon's events and dropped on any event for
+        a container that could change it.
+    '''
+    #   Container events that change inspect data. Notably absent are the
+    #   ``exec_*`` events that every entry generates.
+    EVENTS = [ 'attach', 'create', 'destroy', 'die', 'kill', 'oom', 'pause',
+        'rename', 'restart', 'start', 'stop', 'unpause', 'update' ]
+
+    def __init__(self, inspect):
+        self.inspect = inspect
+        self.entries:dict[str,dict|None] = {}
+        self.watching = False
+        self.generation = 0         # bumped on each invalidation
+        self.lock = threading.Lock()
+
+    def get(self, name:str) -> dict|None:
+        with self.lock:
+            if self.watching and name in self.entries:
+                return self.entries[name]
+            generation = self.generation
+        result = self.inspect(name)
+        with self.lock:
+            #   Unless something happened while we were inspecting.
+            if self.watching and generation == self.generation:
+                self.entries[name] = result
+        return result
+
+    def invalidate(self, watching:bool):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.watching = watching
+
+    def watch(self, engine, retry:float=1.0):
+        ''' Watch `engine`'s events, forever. Entries cached from before
+            we (re)started watching are dropped, and nothing is cached
+            while we're not watching.
+        '''
+        while True:
+            #   Events are requested from now, so none can be missed
+            #   between this and the stream starting.
+            since = time.time()
+            self.invalidate(watching=True)
+            try:
+                for _ in engine.events({ 'type': ['container'],
+                        'event': self.EVENTS }, since, None):
+                    self.invalidate(watching=True)
+            except Exception:
+                pass
+            self.invalidate(watching=False)
+            time.sleep(retry)
+
+def serve() -> int:
+    ''' Run the helper until interrupted. This needs direct access to the
+        daemon socket, and so does not work where ``sudo docker`` is used.
+    '''
+    from    dataclasses  import asdict
+    from    dent  import docker
+    from    dent.util  import die, qprint
+
+    docker.docker_setup()
+    engine, access = docker.ENGINE, docker.ACCESS
+    if engine is None or access is None:
+        die('The helper needs direct access to the Docker daemon socket.')
+    path = socket_path()
+    if running():
+        die(f'A helper is already running on {path}')
+    path.unlink(missing_ok=True)            # a dead helper's
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    cache = Cache(lambda name: engine.inspect('container', name))
+    threading.Thread(target=cache.watch, args=(engine,), daemon=True).start()
+    os.umask(0o077)                         # the socket is for us alone
+    server = make_server(path, cache, asdict(access), docker_env())
+    qprint(False, f'Helper listening on {path}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        path.unlink(missing_ok=True)
+    return 0
+
+def running() -> bool:
+    ' Whether a helper is accepting connections on its socket. '
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(str(socket_path()))
+            return True
+        except OSError:
+            return False
+
+def make_server(path:Path, cache:Cache, access:dict, env:dict[str,str]) -> Any:
+    ''' Return a server on socket `path` answering queries for the Docker
+        environment `env` from `cache` and `access`.
+    '''
+    from    socketserver  import StreamRequestHandler, ThreadingUnixStreamServer
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            reply:dict = {}
+            try:
+                request = json.loads(self.rfile.readline())
+                if request['env'] == env and request['inspect']:
+                    reply = { 'access': access,
+                              'container': cache.get(request['inspect']) }
+            except Exception:
+                pass                        # the client will do without
+            self.wfile.write(json.dumps(reply).encode('UTF-8') + b'\n')
+
+    class Server(ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    return Server(str(path), Handler)
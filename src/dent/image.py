@@ -2,17 +2,19 @@
 
 from    collections import OrderedDict
 from    collections.abc  import Callable
+from    functools  import cache
+from    dataclasses  import dataclass
 from    os.path import join as pjoin
+from    pathlib  import Path
 from    tempfile import mkdtemp
-import  os, shutil, stat, string
+from    typing  import Any, TextIO
+from    urllib.parse  import quote
+import  os, shutil, string, sys, time
 
-from    importlib_resources  import files as resfiles
-
-from    dent  import docker
+from    dent  import docker, locks, trace
 from    dent.configure  import Config, PrintFileName
-from    dent.util  import PROGNAME, PWENT, die, qprint
-
-IMAGE_CONF  : dict[str,str]
+from    dent.util  import (
+        LABEL_PREFIX, PROGNAME, PWENT, die, host_state, qprint)
 
 ####################################################################
 #   Image configuration scripts and related files
@@ -58,42 +60,100 @@ BASE_IMAGES = OrderedDict((
     ('archlinux:latest',{}),
 ))
 
-def resource_text(name):
+def image_conf(base_image:str|None) -> dict[str,str]:
+    ''' Return any special configuration for `base_image` from `BASE_IMAGES`.
+        Base images we don't know get a generic (empty) configuration.
+    '''
+    return BASE_IMAGES.get(base_image or '') or {}
+
+@cache
+def resource_text(name:str) -> str:
+    ''' Return the text of packaged resource file `name`.
+
+        Resources are read only when first needed: most runs of Dent never
+        build an image and so never need them.
+    '''
+    from    importlib_resources  import files as resfiles
     return resfiles().joinpath(name).read_text()
 
-DOCKERFILE      = resource_text('Dockerfile')
-SETUP_HEADER    = resource_text('setup-header')
-SETUP_PKG       = SETUP_HEADER + resource_text('setup-pkg')
-SETUP_USER      = SETUP_HEADER + resource_text('setup-user')
+def setup_script(name:str) -> str:
+    ' Return the text of setup script `name` prefixed by ``setup-header``. '
+    return resource_text('setup-header') + resource_text(name)
 
 class PTemplate(string.Template):
     delimiter = '%'
 
-def dockerfile(base_image:str|None) -> str:
-    ' Return the text of `DOCKERFILE` with template substitution done. '
+#   Where a package cache is mounted (see `use_pkg_cache()`) during the
+#   package stage of the build.
+PKG_CACHE_DIR = '/var/cache/dent'
+
+#   The API version of Docker 23, from which ``docker build`` uses BuildKit
+#   (if the CLI has buildx) unless ``$DOCKER_BUILDKIT`` says otherwise.
+BUILDKIT_DEFAULT_API = (1, 42)
+
+def use_pkg_cache() -> bool:
+    ''' Whether to build with a persistent cache of package downloads. This
+        needs a BuildKit cache mount (``RUN --mount=type=cache``), so we use
+        it only when ``docker build`` uses BuildKit; the classic builder
+        gets the same build without it.
+    '''
+    access = docker.ACCESS
+    if access is None or not access.buildkit:  return False
+    env = os.environ.get('DOCKER_BUILDKIT')
+    if env is not None:  return env == '1'
+    try:
+        api = tuple(int(n) for n in access.api_version.split('.'))
+    except ValueError:
+        return False
+    return api >= BUILDKIT_DEFAULT_API
+
+def dockerfile(base_image:str|None, pkg_cache:bool=False) -> str:
+    ''' Return the text of ``Dockerfile`` with template substitution done,
+        mounting the package cache for ``setup-pkg`` if `pkg_cache`.
+    '''
 
     #   The pre-setup command is run before /tmp/setup-*
     #   This defaults to 'true' (a no-op), but can be set in the BASE_IMAGES
     #   config dict to e.g. install Bash so we can run the setup scripts.
-    presetup_command = IMAGE_CONF.get('presetup') or 'true'
+    presetup_command = image_conf(base_image).get('presetup') or 'true'
     dfargs = {
         'base_image':       base_image,
         'presetup_command': presetup_command,
+        'pkg_cache_mount':  pkg_cache_mount(base_image, pkg_cache),
         'uname':            PWENT.pw_name,
     }
-    return PTemplate(DOCKERFILE).substitute(dfargs)
+    return PTemplate(resource_text('Dockerfile')).substitute(dfargs)
+
+def pkg_cache_mount(base_image:str|None, pkg_cache:bool) -> str:
+    ''' The ``RUN`` option mounting the package cache for `base_image`, if
+        `pkg_cache`, for the ``setup-pkg`` and ``setup-refresh`` steps.
+    '''
+    #   Each base image has its own cache, locked for the duration of a
+    #   build, so builds for other base images can run alongside.
+    if not pkg_cache:  return ''
+    return '--mount=type=cache,id={}-pkg-{},target={},sharing=locked '.format(
+        PROGNAME, (base_image or '').replace(':', '.'), PKG_CACHE_DIR)
 
-def setup_pkg(base_image:str|None) -> str:
-    ' Return the text of `SETUP_PKG` with template substitution done. '
-    useradd = IMAGE_CONF.get('useradd') or 'generic'
+def setup_pkg(base_image:str|None, pkg_cache:bool=False) -> str:
+    ''' Return the text of ``setup-pkg`` with template substitution done,
+        using the package cache mounted by the ``Dockerfile`` if `pkg_cache`.
+    '''
     #   We avoid putting any user-related template arguments here so that
     #   this won't change based on user, thus letting us avoid regenerating
     #   this (fairly heavy) layer when user info changes.
-    return PTemplate(SETUP_PKG).substitute({})
+    return PTemplate(setup_script('setup-pkg')).substitute({
+        'pkg_cache':    PKG_CACHE_DIR if pkg_cache else '' })
+
+def setup_refresh(base_image:str|None, pkg_cache:bool=False) -> str:
+    ''' Return the text of ``setup-refresh`` with template substitution
+        done, using the package cache if `pkg_cache`.
+    '''
+    return PTemplate(setup_script('setup-refresh')).substitute({
+        'pkg_cache':    PKG_CACHE_DIR if pkg_cache else '' })
 
 def setup_user(base_image:str|None) -> str:
-    ' Return the text of `SETUP_USER` with template substitution done. '
-    useradd = IMAGE_CONF.get('useradd') or 'generic'
+    ' Return the text of ``setup-user`` with template substitution done. '
+    useradd = image_conf(base_image).get('useradd') or 'generic'
     template_args = {
         'sudo':             '%sudo',    # Avoid having to escape
         'wheel':            '%wheel',   #    /etc/sudoers groups
@@ -102,72 +162,569 @@ def setup_user(base_image:str|None) -> str:
         'ugecos':           PWENT.pw_gecos,
         'useradd':          useradd,
     }
-    return PTemplate(SETUP_USER).substitute(template_args)
+    return PTemplate(setup_script('setup-user')).substitute(template_args)
 
 #   Things we can print with -P and their functions producing the text.
 #   The key type keeps these in sync with the -P choices in parseargs().
 PRINT_FILE_ARGS : dict[PrintFileName,Callable[[str|None],str]] = {
     'dockerfile':   dockerfile,
     'setup-pkg':    setup_pkg,
+    'setup-refresh':setup_refresh,
     'setup-user':   setup_user,
 }
 
+####################################################################
+#   Build contexts and their content hashes
+#
+#   An image is built in two stages, each from its own context: the package
+#   stage (``setup-pkg``) builds a *package image* from the base image that
+#   is shared by all users and tags, and the user stage (``setup-user``)
+#   builds the image we use on top of that.
+#
+#   Images we build are labelled with a hash of everything that goes into
+#   the build: the files in the build context and the ID of the base image.
+#   When asked to build an image whose inputs hash the same as an existing
+#   image's, we just tag that image instead. The package image is named by
+#   its hash.
+
+HASH_LABEL  = LABEL_PREFIX + 'context-hash'
+BASE_LABEL  = LABEL_PREFIX + 'base-image'
+TAG_LABEL   = LABEL_PREFIX + 'tag'      # the image's `image_alias()` tag
+USER_LABEL  = LABEL_PREFIX + 'user'     # whose setup-user built the image
+STAGE_LABEL = LABEL_PREFIX + 'stage'    # `pkg` on package images
+CLONE_LABEL = LABEL_PREFIX + 'clone-of' # on images `dent.clone` commits
+
+#   Containers Dent creates are labelled with the user who created them,
+#   the time they did (for images, Docker's own creation time suffices)
+#   and the base image, tag and context hash labels of their image.
+CREATED_LABEL = LABEL_PREFIX + 'created'    # ISO 8601 UTC
+IMAGE_LABELS  = (BASE_LABEL, TAG_LABEL, HASH_LABEL)
+
+#   The line in the Dockerfile template starting the user stage.
+USER_STAGE = '#@ user stage\n'
+
+Files = dict[str,tuple[int,str]]        # name: (permissions, contents)
+
+def context_files(base_image:str|None, pkg_cache:bool=False) -> Files:
+    ''' Return the files in the context for building the image for
+        `base_image` in a single stage, with the package cache if
+        `pkg_cache`.
+    '''
+    return {
+        'Dockerfile':   (0o400, dockerfile(base_image, pkg_cache) + '\n'),
+        'setup-pkg':    (0o500, setup_pkg(base_image, pkg_cache) + '\n'),
+        **user_files(base_image),
+    }
+
+def pkg_context_files(base_image:str, pkg_cache:bool=False) -> Files:
+    ''' Return the files in the context for the package stage, with the
+        package cache if `pkg_cache`.
+    '''
+    pkg_stage, _ = dockerfile(base_image, pkg_cache).split(USER_STAGE)
+    return {
+        'Dockerfile':   (0o400, pkg_stage),
+        'setup-pkg':    (0o500, setup_pkg(base_image, pkg_cache) + '\n'),
+    }
+
+def user_context_files(base_image:str, pkg_image:str) -> Files:
+    ''' Return the files in the context for the user stage, building on
+        package image `pkg_image`.
+    '''
+    _, user_stage = dockerfile(base_image).split(USER_STAGE)
+    return {
+        'Dockerfile':   (0o400, f'FROM {pkg_image}\n' + user_stage + '\n'),
+        **user_files(base_image),
+    }
+
+def user_files(base_image:str|None) -> Files:
+    return {
+        'setup-user':   (0o500, setup_user(base_image) + '\n'),
+        #   Staged into the image for setup-user to install (see Dockerfile);
+        #   readable by the build so setup-user can copy it. No templating:
+        #   it uses runtime env.
+        'dent-share':   (0o755, resource_text('dent-share') + '\n'),
+    }
+
+def pkg_image_name(base_image:str, pkg_hash:str) -> str:
+    return '{}/{}-pkg:{}'.format(
+        PROGNAME, base_image.replace(':', '.'), pkg_hash[:12])
+
+def context_hashes(base_image:str, base_id:str, pkg_cache:bool=False,
+        pkg_files:Files|None=None) -> tuple[str,str,Files,Files]:
+    ''' Return the context hashes of the package and user stages for
+        `base_image`, whose image ID is `base_id`, and their context files.
+        The package stage uses the package cache if `pkg_cache`; its
+        context files are `pkg_files`, if already rendered.
+    '''
+    if pkg_files is None:
+        pkg_files = pkg_context_files(base_image, pkg_cache)
+    pkg_hash = context_hash(pkg_files, base_id)
+    files = user_context_files(base_image, pkg_image_name(base_image, pkg_hash))
+    return pkg_hash, context_hash(files, base_id), pkg_files, files
+
+def context_hash(files:Files, base_id:str) -> str:
+    ''' Return the hash (as hex digits) of the build context `files` and
+        the ID of the base image from which they build.
+    '''
+    from    hashlib  import sha256
+    h = sha256(b'dent-context 1\0' + base_id.encode('UTF-8') + b'\0')
+    for name, (mode, text) in sorted(files.items()):
+        data = text.encode('UTF-8')
+        h.update(f'{name}\0{mode:o}\0{len(data)}\0'.encode('UTF-8'))
+        h.update(data)
+    return h.hexdigest()
+
+@trace.phase('base_image_id')
+def base_image_id(conf:Config, output:TextIO|None=None) -> str|None:
+    ''' Return the ID of `conf.base_image`, pulling it if we don't have
+        it, or `None` if we still don't (including on a dry run).
+    '''
+    if not conf.base_image:  return None
+    base = docker.docker_inspect('image', conf.base_image)
+    if base is None:
+        qprint(conf.quiet, "Pulling base image '{}'".format(conf.base_image),
+            file=output)
+        docker.drcall(conf, docker.DOCKER_COMMAND
+            + ('pull', *(('--quiet',) if conf.quiet else ()), conf.base_image),
+            **redirect(output))
+        base = docker.docker_inspect('image', conf.base_image)
+    return None if base is None else base['Id']
+
+def pull_and_render(conf:Config, pkg_cache:bool, output:TextIO|None=None
+        ) -> tuple[str|None,Files|None]:
+    ''' Return the `base_image_id()` of `conf.base_image` and the context
+        files of its package stage, or `None` for both if it has no base
+        image. On a fresh host pulling the base image is most of the time
+        taken to create the first container, so it's done in another
+        thread while we render the context, which depends on the image's
+        ID only for its hash.
+    '''
+    if not conf.base_image:  return None, None
+    from    concurrent.futures  import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='pull') as pool:
+        pull = pool.submit(base_image_id, conf, output)
+        with trace.phase('render_context'):
+            pkg_files = pkg_context_files(conf.base_image, pkg_cache)
+        return pull.result(), pkg_files
+
+def reuse_image(conf:Config, chash:str, output:TextIO|None=None) -> bool:
+    ''' If there is an image built from a context with hash `chash` for
+        `conf.tag`, make sure it's tagged `image_alias(conf)` and return
+        `True`.
+
+        The image already so tagged is used as it is, even if it has since
+        been refreshed. Otherwise only an image as built will do: another
+        refresh of it may have older packages than the latest, and an image
+        built for another tag would give its containers that tag's label.
+    '''
+    alias = image_alias(conf)
+    images = docker.docker_images(f'{HASH_LABEL}={chash}')
+    tagged = [ i for i in images if alias in i['RepoTags'] ]
+    built = [ i for i in images if REFRESH_LABEL not in i['Labels']
+              and i['Labels'].get(TAG_LABEL) == conf.tag ]
+    if tagged:
+        image = tagged[0]
+    elif built:
+        image = built[0]
+        if docker.drcall(conf, docker.DOCKER_COMMAND
+                + ('tag', image['Id'], alias), **redirect(output)) != 0:
+            return False
+    else:
+        return False
+    qprint(conf.quiet, "Using image {} for '{}': same build context {}".format(
+        short_id(image['Id']), alias, chash[:12]), file=output)
+    return True
+
+def short_id(id:str) -> str:
+    ' The short form of an image ID, as ``docker image ls`` shows it. '
+    return id.removeprefix('sha256:')[:12]
+
+def redirect(output:TextIO|None) -> dict:
+    ''' The `drcall()` arguments to send a command's stdout and stderr to
+        `output`, if given.
+    '''
+    return {} if output is None else { 'stdout': output, 'stderr': output }
+
 ####################################################################
 #   Container image build
 
 def build_image(conf:Config):
-    perm_r   = stat.S_IRUSR
-    perm_rx  = perm_r  | stat.S_IXUSR
-    perm_rwx = perm_rx | stat.S_IWUSR
-    if not conf.tmpdir:
-        conf.tmpdir = tmpdir = mkdtemp(prefix=PROGNAME+'-build-')
-    else:
-        tmpdir = conf.tmpdir
-        os.mkdir(tmpdir, perm_rwx)  # We want to die if it already exists
-    qprint(conf.quiet, 'Setting up context for image build in {}'.format(tmpdir),
-        force_print=conf.keep_tmpdir)
-
-    with open(pjoin(tmpdir, 'Dockerfile'), 'w', encoding='UTF-8') as f:
-        os.fchmod(f.fileno(), perm_r)
-        print(dockerfile(conf.base_image), file=f)
-
-    with open(pjoin(tmpdir, 'setup-pkg'), 'w', encoding='UTF-8') as f:
-        os.fchmod(f.fileno(), perm_rx)
-        print(setup_pkg(conf.base_image), file=f)
-
-    with open(pjoin(tmpdir, 'setup-user'), 'w', encoding='UTF-8') as f:
-        os.fchmod(f.fileno(), perm_rx)
-        print(setup_user(conf.base_image), file=f)
-
-    #   Staged into the image for setup-user to install (see Dockerfile);
-    #   readable by the build so setup-user can copy it. No templating: it
-    #   uses runtime env.
-    with open(pjoin(tmpdir, 'dent-share'), 'w', encoding='UTF-8') as f:
-        os.fchmod(f.fileno(), 0o755)
-        print(resource_text('dent-share'), file=f)
-
-    if conf.force_rebuild:
-        qprint(conf.quiet, "Removing image '{}' and forcing full rebuild" \
-            .format(image_alias(conf)))
-        docker.drcall(conf,
-            docker.DOCKER_COMMAND + ('rmi', '-f', image_alias(conf)))
-
-    qprint(conf.quiet, "Building image '{}'".format(image_alias(conf)))
+    ''' Build the image for `conf`, dieing if the build fails. '''
+    if not try_build_image(conf):
+        die("Error building image '{}' from '{}'"
+            .format(image_alias(conf), conf.base_image))
+
+@trace.phase('build_image')
+def try_build_image(conf:Config, output:TextIO|None=None) -> bool:
+    ''' Build the image for `conf`, returning `True` if it succeeded.
+        If an image was already built from the same context it's used
+        instead, and the package image is built only if it doesn't exist,
+        unless `conf.force_rebuild` is set.
+
+        Only one Dent process at a time builds a given image (or package
+        image); others wait for it and then, having the same context hash,
+        usually just use the image it built.
+
+        If `output` is given, our messages and the output of the Docker
+        commands go to it rather than our stdout and stderr.
+    '''
+    with locks.hold('image', image_alias(conf), quiet=conf.quiet, file=output):
+        return build_locked(conf, output)
+
+def build_locked(conf:Config, output:TextIO|None) -> bool:
+    started = time.monotonic()
+    alias = image_alias(conf)
+    base = conf.base_image
+    pkg_cache = use_pkg_cache()
+    base_id, pkg_files = pull_and_render(conf, pkg_cache, output)
+    #   The context is normally sent to `docker build` on its stdin, but
+    #   written to a directory if the user wants to see it.
+    tmpdir = None
+    if conf.tmpdir or conf.keep_tmpdir:
+        tmpdir = make_tmpdir(conf, output)
+
+    def build(stage, tag, files, labels) -> bool:
+        return docker_build(conf, tmpdir, stage, tag, files, labels,
+            no_cache=conf.force_rebuild, output=output)
+
+    def full_build_done(ok:bool) -> bool:
+        if ok and not conf.dry_run:
+            record_build_time(alias, time.monotonic() - started)
+        return ok
+
+    def remove_alias():
+        if conf.force_rebuild:
+            qprint(conf.quiet, "Removing image '{}' and forcing full rebuild" \
+                .format(alias), file=output)
+            docker.drcall(conf, docker.DOCKER_COMMAND + ('rmi', '-f', alias),
+                **redirect(output))
+
+    try:
+        if base is None or base_id is None:
+            #   We can't name the package image without the base image's ID
+            #   (e.g., on a dry run where it has not been pulled), so build
+            #   in a single stage.
+            remove_alias()
+            qprint(conf.quiet, "Building image '{}'".format(alias), file=output)
+            return full_build_done(build('image', alias,
+                context_files(base, pkg_cache),
+                { k: v for k, v in ((BASE_LABEL, base), (TAG_LABEL, conf.tag))
+                  if v }))
+
+        pkg_hash, chash, pkg_files, files \
+            = context_hashes(base, base_id, pkg_cache, pkg_files)
+        if not conf.force_rebuild and reuse_image(conf, chash, output):
+            return True
+        pkg_image = pkg_image_name(base, pkg_hash)
+        pkg_built = False
+        with locks.hold('image', pkg_image, quiet=conf.quiet, file=output):
+            if conf.force_rebuild \
+                    or docker.docker_inspect('image', pkg_image) is None:
+                pkg_built = True
+                qprint(conf.quiet, "Building package image '{}'"
+                    .format(pkg_image), file=output)
+                if not build('pkg', pkg_image, pkg_files, {
+                        HASH_LABEL: pkg_hash, BASE_LABEL: base,
+                        STAGE_LABEL: 'pkg', }):
+                    return False
+        remove_alias()
+        qprint(conf.quiet, "Building image '{}'".format(alias), file=output)
+        ok = build('user', alias, files, { HASH_LABEL: chash,
+            BASE_LABEL: base, TAG_LABEL: conf.tag,
+            USER_LABEL: PWENT.pw_name, })
+        #   Only a build of both stages is a full build to compare with.
+        return full_build_done(ok) if pkg_built else ok
+    finally:
+        if tmpdir is not None and not conf.keep_tmpdir:
+            shutil.rmtree(tmpdir)
+
+def docker_build(conf:Config, tmpdir:str|None, stage:str, tag:str,
+        files:Files, labels:dict[str,str], *, no_cache:bool=False,
+        output:TextIO|None=None) -> bool:
+    ''' Run ``docker build`` for the context `files`, tagging the image
+        `tag` and labelling it with `labels`, returning `True` if it
+        succeeded. The context is sent on its stdin or, if `tmpdir` is
+        given, written to the `stage` directory under it.
+    '''
+    context = '-' if tmpdir is None \
+        else write_context(pjoin(tmpdir, stage), files)
     command = docker.DOCKER_COMMAND + ('build',)
     if conf.progress:
         command += ('--progress=plain',)
     if conf.quiet:
         command += ('--quiet',)
-    if conf.force_rebuild:
+    if no_cache:
         command += ('--no-cache',)
-    command += ('--tag', image_alias(conf), tmpdir)
-    retcode = docker.drcall(conf, command)
-    if retcode != 0:
-        die("Error building image '{}' from '{}'"
-            .format(image_alias(conf), conf.base_image))
+    command += tuple( f'--label={k}={v}' for k, v in labels.items() )
+    command += ('--tag', tag, context)
+    input = context_tar(files) if tmpdir is None else None
+    return 0 == docker.drcall(conf, command, input=input, **redirect(output))
+
+def make_tmpdir(conf:Config, output:TextIO|None=None) -> str:
+    ''' Create `conf.tmpdir` (which must not exist), or a new temporary
+        directory, to hold the build contexts, returning its path.
+    '''
+    if not conf.tmpdir:
+        conf.tmpdir = tmpdir = mkdtemp(prefix=PROGNAME+'-build-')
+    else:
+        tmpdir = conf.tmpdir
+        os.mkdir(tmpdir, 0o700)     # We want to die if it already exists
+    qprint(conf.quiet, 'Setting up context for image build in {}'.format(tmpdir),
+        force_print=conf.keep_tmpdir, file=output)
+    return tmpdir
+
+def write_context(path:str, files:Files) -> str:
+    ''' Write the build context `files` to new directory `path`,
+        returning it.
+    '''
+    os.mkdir(path, 0o700)
+    for name, (mode, text) in files.items():
+        with open(pjoin(path, name), 'w', encoding='UTF-8') as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(text)
+    return path
+
+def context_tar(files:Files) -> bytes:
+    ''' Return the build context `files` as an (uncompressed) tar archive.
+        The files are owned by root with a fixed modification time so that
+        the archive, like `context_hash()`, depends only on the contents.
+    '''
+    import  io, tarfile
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tf:
+        for name, (mode, text) in files.items():
+            data = text.encode('UTF-8')
+            info = tarfile.TarInfo(name)
+            info.size, info.mode = len(data), mode
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+def container_labels(image_name:str) -> dict[str,str]:
+    ''' The labels for a container Dent creates from `image_name`: its
+        user and creation time and the `IMAGE_LABELS` of the image, if it
+        has them.
+    '''
+    image = docker.docker_inspect('image', image_name) or {}
+    labels = (image.get('Config') or {}).get('Labels') or {}
+    return { USER_LABEL: PWENT.pw_name,
+             CREATED_LABEL: time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+             **{ k: labels[k] for k in IMAGE_LABELS if labels.get(k) }, }
+
+####################################################################
+#   Package refresh
+#
+#   Rather than rebuilding an image from its base image to bring its
+#   packages up to date, a refresh builds a single new layer on top of the
+#   current image that runs just the distro's upgrade (``setup-refresh``).
+#   Each refresh adds a layer, so after `REFRESH_SQUASH` of them the next
+#   instead starts again from the image as originally built: its one layer
+#   holds all the upgrades since, and the image keeps sharing its lower
+#   layers with the package image. (Flattening the image would lose that.)
+
+REFRESH_LABEL = LABEL_PREFIX + 'refreshes'  # refresh layers on the build
+REFRESH_SQUASH = 4
+
+@dataclass
+class Refresh:
+    ''' The time a refresh took and the bytes it added, and the same for
+        the last full build of the image, if known.
+    '''
+    seconds         : float
+    bytes           : int|None
+    full_seconds    : float|None
+    full_bytes      : int|None
+
+    def saved(self) -> str:
+        from    dent.inventory  import size
+        saved = []
+        if self.full_seconds is not None:
+            saved.append(f'{self.full_seconds - self.seconds:.1f}s')
+        if self.full_bytes is not None and self.bytes is not None:
+            n = self.full_bytes - self.bytes
+            saved.append(('-' if n < 0 else '') + size(abs(n)))
+        return ' and '.join(saved) or 'unknown'
+
+def build_time_path(alias:str) -> Path:
+    ''' The file recording how long the last full build (both stages) of
+        image `alias` took.
+    '''
+    return host_state() / 'build-times' / quote(alias, safe='')
+
+def record_build_time(alias:str, seconds:float):
+    path = build_time_path(alias)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    tmp.write_text(f'{seconds:.1f}\n')
+    tmp.replace(path)
+
+def last_build_time(alias:str) -> float|None:
+    try:
+        return float(build_time_path(alias).read_text())
+    except (OSError, ValueError):
+        return None
+
+def refresh_files(base_image:str|None, from_image:str, user:str,
+        pkg_cache:bool=False) -> Files:
+    ''' Return the files in the context for refreshing the packages of
+        image `from_image`, whose user is `user`, using the package cache
+        for `base_image` if `pkg_cache`.
+    '''
+    return {
+        'Dockerfile':   (0o400, f'FROM {from_image}\n'
+            'USER root\n'
+            'COPY setup-refresh /tmp/\n'
+            f'RUN {pkg_cache_mount(base_image, pkg_cache)}'
+            '["/bin/bash", "/tmp/setup-refresh"]\n'
+            f'USER {user}\n'),
+        'setup-refresh':(0o500, setup_refresh(base_image, pkg_cache) + '\n'),
+    }
+
+@trace.phase('refresh_image')
+def try_refresh_image(conf:Config, output:TextIO|None=None) -> Refresh|None:
+    ''' Upgrade the packages in the existing image for `conf`, returning
+        how long that took and what it added, or `None` if it failed.
+        Only one Dent process at a time builds or refreshes a given image.
+
+        If `output` is given, our messages and the output of the Docker
+        commands go to it rather than our stdout and stderr.
+    '''
+    with locks.hold('image', image_alias(conf), quiet=conf.quiet, file=output):
+        return refresh_locked(conf, output)
+
+def refresh_locked(conf:Config, output:TextIO|None) -> Refresh|None:
+    alias = image_alias(conf)
+    current = docker.docker_inspect('image', alias)
+    if current is None:
+        print("No image '{}' to refresh; build it first".format(alias),
+            file=output or sys.stderr)
+        return None
+    labels = (current.get('Config') or {}).get('Labels') or {}
+    refreshes = int(labels.get(REFRESH_LABEL) or 0)
+    start = current
+    if refreshes >= REFRESH_SQUASH:
+        built = built_image(labels.get(HASH_LABEL))
+        if built is None:
+            qprint(conf.quiet, 'Cannot squash the {} refresh layers of {}:'
+                ' the image as built is gone; use -R to rebuild it'
+                .format(refreshes, alias), file=output)
+        else:
+            qprint(conf.quiet, 'Squashing {} refresh layers into one,'
+                ' refreshing {} as built'.format(
+                    refreshes, short_id(built['Id'])), file=output)
+            start, refreshes = built, 0
+
+    tmpdir = None
+    if conf.tmpdir or conf.keep_tmpdir:
+        tmpdir = make_tmpdir(conf, output)
+    try:
+        qprint(conf.quiet, "Refreshing packages in image '{}'".format(alias),
+            file=output)
+        started = time.monotonic()
+        #   Without --no-cache the upgrade step would be found in the build
+        #   cache and do nothing.
+        if not docker_build(conf, tmpdir, 'refresh', alias,
+                refresh_files(conf.base_image, start['Id'],
+                    (start.get('Config') or {}).get('User') or 'root',
+                    use_pkg_cache()),
+                { REFRESH_LABEL: str(refreshes + 1) }, no_cache=True,
+                output=output):
+            return None
+        seconds = time.monotonic() - started
+    finally:
+        if tmpdir is not None and not conf.keep_tmpdir:
+            shutil.rmtree(tmpdir)
+    if conf.dry_run:
+        return Refresh(seconds, None, None, None)
+
+    new = docker.docker_inspect('image', alias) or {}
+    base = docker.docker_inspect('image', labels.get(BASE_LABEL) or '') \
+        if labels.get(BASE_LABEL) else None
+    refresh = Refresh(seconds,
+        new['Size'] - start['Size'] if 'Size' in new else None,
+        last_build_time(alias),
+        current['Size'] - base['Size'] if base is not None else None)
+    from    dent.inventory  import size
+    qprint(conf.quiet, "Refreshed image '{}' in {:.1f}s adding {};"
+        ' saved {} over a full rebuild'.format(alias, seconds,
+            '?' if refresh.bytes is None else size(refresh.bytes),
+            refresh.saved()), force_print=True, file=output)
+    return refresh
+
+def built_image(chash:str|None) -> dict[str,Any]|None:
+    ''' The inspect data of the image built (not refreshed) from context
+        hash `chash`, if it still exists. Refreshed images carry the hash
+        label of the image they were built from.
+    '''
+    if not chash:  return None
+    for image in docker.docker_images(f'{HASH_LABEL}={chash}'):
+        if REFRESH_LABEL not in image['Labels']:
+            return docker.docker_inspect('image', image['Id'])
+    return None
+
+####################################################################
+#   Images built by Dent, by context hash
+
+def cached_images(shared_size:bool=False
+        ) -> list[tuple[dict[str,Any],str]]:
+    ''' Return each image Dent built (not committed) for this user, and
+        each package image, (as `docker_images()` gives them, with
+        `shared_size` if requested) with its state:
+        ``current`` if it was built from the context we would use now,
+        ``stale`` if not (or it's a refresh of an image that has since been
+        refreshed again), or ``unknown`` if we cannot tell because we don't
+        have its base image.
+    '''
+    #   Base image to current package and user context hashes.
+    current:dict[str,tuple[str,str]|None] = {}
+    pkg_cache = use_pkg_cache()
+    images = []
+    for image in docker.docker_images(f'{STAGE_LABEL}=pkg', shared_size) \
+            + docker.docker_images(f'{USER_LABEL}={PWENT.pw_name}',
+                shared_size):
+        labels = image['Labels']
+        #   Committed from a container, not built; see `dent.clone`.
+        if CLONE_LABEL in labels:  continue
+        base = labels.get(BASE_LABEL, '')
+        if base not in current:
+            b = docker.docker_inspect('image', base) if base else None
+            current[base] = None if b is None \
+                else context_hashes(base, b['Id'], pkg_cache)[:2]
+        hashes = current[base]
+        is_pkg = labels.get(STAGE_LABEL) == 'pkg'
+        state = 'unknown' if hashes is None \
+            else 'current' if labels.get(HASH_LABEL) == hashes[not is_pkg] \
+            else 'stale'
+        #   A refresh untags the one it replaces. (The image as built is
+        #   kept for squashing later refreshes.)
+        if REFRESH_LABEL in labels and not image['RepoTags']:
+            state = 'stale'
+        images.append((image, state))
+    return images
+
+def list_image_cache():
+    print('CONTEXT HASH  IMAGE ID      STATE    TAGS')
+    for image, state in cached_images():
+        print('{:<12}  {}  {:<7}  {}'.format(
+            image['Labels'].get(HASH_LABEL, '')[:12], short_id(image['Id']),
+            state, ' '.join(image['RepoTags']) or '<none>'))
 
-    if not conf.keep_tmpdir:
-        shutil.rmtree(tmpdir)
+def prune_image_cache(conf:Config) -> int:
+    ''' Remove the stale images from `cached_images()`, returning 1 if
+        any could not be removed (usually because a container or another
+        image is using it), otherwise 0.
+    '''
+    failed = 0
+    #   Users' images first, as they may be using stale package images.
+    for image, state in reversed(cached_images()):
+        if state != 'stale':  continue
+        qprint(conf.quiet, 'Removing stale image {} {}'.format(
+            short_id(image['Id']), ' '.join(image['RepoTags'])))
+        #   Removing by tag leaves the image if another tag or a container
+        #   still uses it; it will be removed by ID on a later prune.
+        if docker.drcall(conf, docker.DOCKER_COMMAND
+                + ('image', 'rm', *(image['RepoTags'] or [image['Id']]))):
+            failed += 1
+    return 1 if failed else 0
 
 def image_alias(conf:Config) -> str:
     ' "Alias" is name plus tag '
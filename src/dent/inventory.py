@@ -0,0 +1,121 @@
+''' dent.inventory - the containers Dent has created, from their labels
+
+    Containers Dent creates carry the `dent.image.container_labels()`, so
+    a user's Dent containers, with their state, image and disk use, come
+    from a single query of the daemon however many containers there are.
+    (Containers created before Dent labelled them are not included.) The
+    time each was last entered comes from its Dent share, as recorded by
+    `dent.container.record_entry()`. The user's cache volumes (see
+    `dent.container.CACHES`) and the containers mounting them are listed
+    with them.
+
+    `stop_idle()` stops those of them that have been idle for a while,
+    to free the memory they hold.
+'''
+
+from    subprocess  import DEVNULL
+from    typing  import Any
+import  time
+
+from    dent  import docker
+from    dent.configure  import Config
+from    dent.container  import CACHE_LABEL, IDLE_STAMP, last_entry
+from    dent.image  import CREATED_LABEL, TAG_LABEL, USER_LABEL
+from    dent.pool  import POOL_PREFIX
+from    dent.util  import PWENT, qprint, state_home
+
+def containers(size:bool=True) -> list[dict[str,Any]]:
+    ''' The user's Dent containers, less those waiting in a pool, sorted by
+        name. Each is as from `docker.docker_containers()`, except that
+        ``Created`` is from our label if it has one, plus the time it was
+        last ``Entered`` (`None` if unknown).
+    '''
+    cs = []
+    for c in docker.docker_containers([f'{USER_LABEL}={PWENT.pw_name}'], size):
+        if c['Name'].startswith(POOL_PREFIX):  continue
+        created = c['Labels'].get(CREATED_LABEL)
+        if created:  c['Created'] = docker.unix_time(created)
+        c['Entered'] = last_entry(c['Name'])
+        cs.append(c)
+    return sorted(cs, key=lambda c: c['Name'])
+
+def print_status(now:float|None=None):
+    if now is None:  now = time.time()
+    cs = containers()
+    rows:list[tuple[str,...]] \
+        = [ ('NAME', 'STATE', 'IMAGE', 'TAG', 'CREATED', 'ENTERED', 'SIZE') ]
+    for c in cs:
+        rows.append((c['Name'], c['State'], c['Image'],
+            c['Labels'].get(TAG_LABEL, '-'), age(now, c['Created']),
+            age(now, c['Entered']), size(c['SizeRw'])))
+    print_table(rows)
+
+    caches = docker.docker_volumes(
+        [CACHE_LABEL, f'{USER_LABEL}={PWENT.pw_name}'])
+    if not caches:  return
+    rows = [ ('CACHE', 'VOLUME', 'CREATED', 'SIZE', 'USED BY') ]
+    for v in sorted(caches, key=lambda v: v['Name']):
+        rows.append((v['Labels'][CACHE_LABEL], v['Name'],
+            age(now, v['Created']), size(v['Size']),
+            ' '.join(c['Name'] for c in cs if v['Name'] in c['Volumes'])
+            or '-'))
+    print()
+    print_table(rows)
+
+def print_table(rows:list[tuple[str,...]]):
+    ' Print `rows`, the first being the headings, in aligned columns. '
+    widths = [ max(len(r[i]) for r in rows) for i in range(len(rows[0])) ]
+    for r in rows:
+        print('  '.join(f'{v:<{w}}' for v, w in zip(r, widths)).rstrip())
+
+def stop_idle(conf:Config, idle:float, now:float|None=None) -> int:
+    ''' Stop the user's running Dent containers that have not been entered
+        or started in the last `idle` seconds and have no ``docker exec``
+        sessions running, returning the exit code of ``docker stop`` (0 if
+        there's nothing to stop). Such a container is marked as stopped for
+        being idle, so that the next entry restarts it quietly.
+
+        Processes the user left running in the container other than
+        through a ``docker exec`` do not prevent it being stopped.
+    '''
+    if now is None:  now = time.time()
+    names = []
+    for c in containers(size=False):
+        if not c['Running']:  continue
+        last = max(c['Entered'] or 0, c['Created'])
+        if now - last < idle:  continue
+        #   Only those that might be idle are worth inspecting.
+        inspect = docker.docker_inspect('container', c['Name'])
+        if inspect is None or not inspect['State']['Running']:  continue
+        started = docker.unix_time(inspect['State'].get('StartedAt', ''))
+        last = max(last, started)
+        #   The daemon forgets each exec session as it ends.
+        if now - last < idle or inspect.get('ExecIDs'):  continue
+        qprint(conf.quiet, "Stopping idle container '{}', last used {}"
+            .format(c['Name'], age(now, last)))
+        names.append(c['Name'])
+    if not names:  return 0
+    if not conf.dry_run:
+        for name in names:
+            share = state_home() / 'dent' / name
+            if share.is_dir():  (share / IDLE_STAMP).touch()
+    return docker.drcall(conf, docker.DOCKER_COMMAND + ('stop', *names),
+        stdout=DEVNULL)
+
+def age(now:float, t:float|None) -> str:
+    ' How long before `now` was Unix time `t`, briefly. '
+    if not t:  return '-'
+    secs = max(0, int(now - t))
+    for unit, n in (('d', 86400), ('h', 3600), ('m', 60)):
+        if secs >= n:  return f'{secs // n}{unit} ago'
+    return f'{secs}s ago'
+
+def size(n:int|None) -> str:
+    ' Byte count `n`, briefly, in SI units as Docker gives them. '
+    if n is None:  return '-'
+    if n < 1000:  return f'{n}B'
+    x = n / 1000
+    for unit in ('kB', 'MB', 'GB'):
+        if x < 1000:  return f'{x:.1f}{unit}'
+        x /= 1000
+    return f'{x:.1f}TB'
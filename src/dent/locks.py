@@ -0,0 +1,55 @@
+''' dent.locks - advisory locks shared by concurrent Dent processes
+
+    A lock is an exclusive `flock(2)` lock on a file under ``locks/`` in
+    Dent's host state dir. The kernel releases it when the process holding
+    it exits, however that happens, so a lock file left behind by a killed
+    process is not locked and needs no clean-up; the process ID recorded
+    in the file is only for telling the user who they're waiting for.
+'''
+
+from    collections.abc  import Iterator
+from    contextlib  import contextmanager
+from    pathlib  import Path
+from    typing  import TextIO
+from    urllib.parse  import quote
+import  fcntl, os
+
+from    dent  import trace
+from    dent.util  import host_state, qprint
+
+def lock_path(kind:str, name:str) -> Path:
+    ''' The lock file for `name`, a `kind` of thing (``container``,
+        ``image``, etc.). Names are quoted, since image names contain
+        ``/``.
+    '''
+    return host_state() / 'locks' / kind / (quote(name, safe='') + '.lock')
+
+@contextmanager
+def hold(kind:str, name:str, *, wait:bool=True, quiet:bool=False,
+        file:TextIO|None=None) -> Iterator[bool]:
+    ''' Hold the lock for `name` (see `lock_path()`) for the body, yielding
+        `True`. If another process holds it, wait for it (saying so to
+        `file`, default stdout, unless `quiet`) or, if not `wait`, yield
+        `False` without holding the lock.
+    '''
+    path = lock_path(kind, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                yield False
+                return
+            holder = os.pread(fd, 32, 0).decode('ASCII', 'replace').strip()
+            qprint(quiet, 'Waiting for process {} to finish with {} {!r}'
+                .format(holder or '(unknown)', kind, name), file=file,
+                flush=True)
+            with trace.span('lock', f'{kind} {name}'):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, f'{os.getpid()}\n'.encode('ASCII'), 0)
+        yield True
+    finally:
+        os.close(fd)            # releasing the lock
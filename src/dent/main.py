@@ -4,24 +4,78 @@
     the full repo, you can find it at <https://github.com/cynic-net/dent/>.
 '''
 
-from    importlib.metadata  import version
+#   Dent is often run in tight loops from scripts, so start-up time matters.
+#   Modules other than those needed to enter an existing container (in
+#   particular the image build machinery in `dent.image`) are imported only
+#   when used; `main.pt` checks this.
 
-from    dent  import configure, container, image
-from    dent.configure  import Config, ListBaseImages, PrintFile, PrintVersion
+from    dent  import configure, trace
+from    dent.configure  import (
+        BuildImages, CloneContainer, CollectGarbage, Command, Config,
+        ImageCache, ListBaseImages, PrintFile, PrintVersion, RunBatch,
+        RunHelper, Status, StopIdle)
 from    dent.util  import PROGNAME
+import  time
 
 def main(argv:list[str]|None=None):
-    match configure.parseargs(argv):
+    t0 = time.monotonic()
+    command = configure.parseargs(argv)
+    conf = getattr(command, 'conf', command)
+    trace.start(t0, isinstance(conf, Config) and conf.trace)
+    status = None
+    try:
+        status = run(command)
+        return status
+    except SystemExit as e:
+        status = e.code
+        raise
+    finally:
+        trace.finish(status)
+
+def run(command:Command|Config):
+    match command:
      case PrintVersion():
+        from    importlib.metadata  import version
         print(f'{PROGNAME} version {version(PROGNAME)}')
      case ListBaseImages():
+        from    dent  import image
         for i in image.BASE_IMAGES: print(i)
      case PrintFile(file, base_image):
-        image.IMAGE_CONF = image.BASE_IMAGES.get(base_image or '') or {}
+        from    dent  import image
         print(image.PRINT_FILE_ARGS[file](base_image))
+     case RunBatch() as run:
+        from    dent  import batch
+        return batch.run_batch(run)
+     case ImageCache('list'):
+        from    dent  import docker, image
+        docker.docker_setup()
+        image.list_image_cache()
+     case ImageCache('prune', conf):
+        from    dent  import docker, image
+        docker.docker_setup()
+        return image.prune_image_cache(conf)
+     case BuildImages() as build:
+        from    dent  import batch
+        return batch.build_images(build)
+     case CloneContainer() as run:
+        from    dent  import clone
+        return clone.clone(run)
+     case Status():
+        from    dent  import docker, inventory
+        docker.docker_setup()
+        inventory.print_status()
+     case StopIdle(idle, conf):
+        from    dent  import docker, inventory
+        docker.docker_setup()
+        return inventory.stop_idle(conf, idle)
+     case CollectGarbage(max_age, keep, conf):
+        from    dent  import docker, garbage
+        docker.docker_setup()
+        return garbage.collect(conf, max_age, keep)
+     case RunHelper():
+        from    dent  import helper
+        return helper.serve()
      case Config() as conf:
-        #   If we know the given base image name, get any special
-        #   configuration for it. Otherwise we use a generic config.
-        image.IMAGE_CONF \
-            = image.BASE_IMAGES.get(conf.base_image or '') or {}
+        with trace.phase('import'):
+            from    dent  import container
         return container.enter_container(conf)
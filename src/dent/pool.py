@@ -0,0 +1,160 @@
+''' dent.pool - warm pools of pre-started containers
+
+    With ``--pool N``, creating a new container first tries to claim one
+    from the *pool* for its image: containers created (by `fill()`) with
+    exactly the `docker run` command `dent.container.create_container()`
+    would use, but under a placeholder name, and left running. Claiming
+    one renames it and links its Dent share to the new name, saving the
+    ``docker run`` and the wait for the container to start. Either way,
+    the pool is then topped back up to N by a background process.
+
+    A pooled container's Dent share is ``.pool/<placeholder>`` in the dir
+    holding the shares; the claimed container's share is a relative
+    symlink to that, made both on the host and in the container so that
+    ``dent-share dir`` finds it in both. ``$DENT_CONTAINER`` is passed on
+    each ``docker exec``, as the container's own is the placeholder name.
+    The one thing that cannot be changed is the container's hostname,
+    which remains the placeholder name.
+
+    Pools are per user and per image, and no container is added to them
+    when the user already has `POOL_MAX` pooled containers or the host
+    has less than `POOL_MIN_AVAILABLE` bytes of memory available.
+'''
+
+from    pathlib  import Path
+from    subprocess  import DEVNULL, Popen
+import  secrets, shutil, sys
+
+from    dent  import container, docker, image, locks
+from    dent.configure  import Config, option_defaults
+from    dent.util  import LABEL_PREFIX, PWENT, host_state, qprint, state_home
+
+POOL_LABEL  = LABEL_PREFIX + 'pool'         # the image the pool is for
+POOL_PREFIX = 'dent-pool-'                  # of placeholder names
+
+#   Limits on the containers `fill()` will create.
+POOL_MAX            = 16        # pooled containers per user, all images
+POOL_MIN_AVAILABLE  = 1 << 30   # bytes of host memory available
+
+def pool_share(name:str) -> Path:
+    ' The Dent share of pooled container `name`. '
+    return state_home() / 'dent' / '.pool' / name
+
+def members(image_name:str|None=None) -> list[dict]:
+    ''' The user's pooled containers (as from `docker.docker_containers()`)
+        for `image_name`, or for all images if it's `None`.
+    '''
+    pool = POOL_LABEL if image_name is None else f'{POOL_LABEL}={image_name}'
+    return [ c for c in docker.docker_containers(
+                [pool, f'{image.USER_LABEL}={PWENT.pw_name}'])
+             if c['Name'].startswith(POOL_PREFIX) ]
+
+def claim(conf:Config) -> bool:
+    ''' Try to claim a running container from the pool for the new
+        container `conf.CONTAINER_NAME`'s image, returning `True` if we
+        did. Containers with their own ``docker run`` options (-C, -r, -s,
+        -S) or that are to be rebuilt (-R) are never claimed.
+    '''
+    if conf.dry_run or conf.force_rebuild or conf.cache \
+            or conf.run_opt or conf.share_ro or conf.share_rw:
+        return False
+    share = container.dent_share(conf)
+    if share.exists() or share.is_symlink():
+        return False                # we'd not be able to link it
+    alias = image.image_alias(conf)
+    current = docker.docker_inspect('image', alias)
+    if current is None:
+        return False
+    for c in members(alias):
+        inspect = docker.docker_inspect('container', c['Name'])
+        if inspect is None or not inspect['State']['Running'] \
+                or inspect['Image'] != current['Id']:
+            continue                # gone, stopped or stale
+        #   Renaming is atomic, so only one of several Dent processes
+        #   claiming at once can get any given container.
+        if docker.drcall(conf, docker.DOCKER_COMMAND
+                + ('rename', c['Name'], conf.CONTAINER_NAME),
+                stdout=DEVNULL, stderr=DEVNULL) != 0:
+            continue
+        link = Path('.pool') / c['Name']
+        share.parent.mkdir(parents=True, exist_ok=True)
+        share.symlink_to(link)
+        docker.drcall(conf, docker.DOCKER_COMMAND + ('exec', '--user=0',
+            conf.CONTAINER_NAME, 'ln', '-s', str(link), str(share)))
+        qprint(conf.quiet, "Claimed pooled container '{}' from image '{}'"
+            " as '{}'".format(c['Name'], alias, conf.CONTAINER_NAME))
+        return True
+    return False
+
+def refill(conf:Config):
+    ''' Start a background process to fill the pool for `conf`'s image to
+        `conf.pool` containers. Its output is appended to ``pool.log`` in
+        Dent's host state dir.
+    '''
+    if conf.dry_run:  return
+    log = host_state() / 'pool.log'
+    log.parent.mkdir(parents=True, exist_ok=True)
+    with open(log, 'ab') as out:
+        Popen([sys.executable, '-m', 'dent.pool',
+                image.image_alias(conf), str(conf.pool)],
+            stdin=DEVNULL, stdout=out, stderr=out, start_new_session=True)
+
+def fill(image_name:str, size:int) -> int:
+    ''' Create pooled containers from `image_name` until there are `size`
+        of them or a pool limit has been reached, first removing any of
+        its pooled containers that are stopped or whose image is stale.
+        Returns 0, or 1 if a container could not be created.
+
+        Only one `fill()` for each image runs at a time; any others for
+        that image just return.
+    '''
+    conf = Config(CONTAINER_NAME='', COMMAND=[],
+        **(option_defaults() | { 'image': image_name, 'quiet': True }))
+    with locks.hold('pool', image_name, wait=False) as held:
+        if not held:  return 0
+        return fill_locked(conf, image_name, size)
+
+def fill_locked(conf:Config, image_name:str, size:int) -> int:
+    docker.docker_setup()
+    current = docker.docker_inspect('image', image_name)
+    ready = 0
+    for c in members(image_name):
+        inspect = docker.docker_inspect('container', c['Name'])
+        if inspect is None:  continue
+        if inspect['State']['Running'] and current is not None \
+                and inspect['Image'] == current['Id']:
+            ready += 1
+        else:
+            docker.drcall(conf, docker.DOCKER_COMMAND
+                + ('rm', '--force', c['Name']), stdout=DEVNULL)
+            shutil.rmtree(pool_share(c['Name']), ignore_errors=True)
+    while ready < size and len(members()) < POOL_MAX:
+        available = mem_available()
+        if available is not None and available < POOL_MIN_AVAILABLE:
+            break
+        name = POOL_PREFIX + secrets.token_hex(4)
+        share = pool_share(name)
+        (share / 'entry-script').mkdir(parents=True)
+        command = container.run_command(
+            Config(**(vars(conf) | { 'CONTAINER_NAME': name })),
+            image_name, share, '--label={}={}'.format(POOL_LABEL, image_name))
+        if docker.drcall(conf, command, stdout=DEVNULL) != 0:
+            return 1
+        ready += 1
+    return 0
+
+def mem_available() -> int|None:
+    ''' The memory available on the host for new processes, in bytes, or
+        `None` if we can't tell.
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+if __name__ == '__main__':
+    exit(fill(sys.argv[1], int(sys.argv[2])))
@@ -0,0 +1,162 @@
+''' dent.stream - run commands in containers with Dent copying their I/O
+
+    With ``--native-exec``, when its standard input is not a terminal,
+    Dent runs the command itself through the Engine API rather than
+    exec'ing ``docker exec``: it creates and starts an exec instance and
+    copies data between its own standard input, output and error and the
+    connection the daemon hands over for the exec's I/O.
+
+    The daemon sends the output as a series of frames, each an 8-byte
+    header (the stream, 1 for stdout or 2 for stderr, then three zero
+    bytes and the big-endian 32-bit length of the data) followed by the
+    data. The input is sent as is, and we shut down our side of the
+    connection at end of input. Data is moved with `os.splice()` (or, from
+    a regular file, `os.sendfile()`) where the kernel allows, so that it
+    is not copied into and out of our process.
+'''
+
+from    typing  import Any
+import  errno, os, socket, stat, struct, threading, time
+
+from    dent.util  import die
+
+#   Bytes moved per system call; also the size of a pipe's buffer.
+CHUNK = 1 << 16
+
+#   The errors from splice(2) and sendfile(2) meaning that they can't be
+#   used on these files.
+UNSPLICEABLE = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+def run_exec(engine:Any, name:str, cmd:list[str], env:list[str],
+        stdin:int=0, stdout:int=1, stderr:int=2) -> int:
+    ''' Run `cmd` in container `name`, using `dent.engine.Engine`
+        `engine`, with the ``NAME=value`` environment settings `env` and
+        the given standard I/O file descriptors, returning its exit code.
+    '''
+    id = engine.exec_create(name, cmd, env)
+    with engine.exec_start(id) as sock:
+        #   This may still be blocked reading our input when the exec ends.
+        threading.Thread(target=send_input, args=(stdin, sock),
+            daemon=True).start()
+        receive_output(sock, stdout, stderr)
+    return exit_code(engine, id)
+
+def exit_code(engine:Any, id:str) -> int:
+    ''' The exit code of exec instance `id`, whose output has ended. Its
+        process may still be running (having closed its output), in which
+        case we wait for it to exit, as ``docker exec`` does.
+    '''
+    delay = 0.01
+    while True:
+        inspect = engine.inspect('exec', id)
+        if inspect is None:
+            die(f'Exec instance {id[:12]} has gone; its exit code is unknown')
+        if not inspect.get('Running') and inspect.get('ExitCode') is not None:
+            return inspect['ExitCode']
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def send_input(fd:int, sock:socket.socket):
+    ' Send all data from `fd` to the exec, ending its input at EOF. '
+    try:
+        copy = Copier(fd, sock.fileno())
+        while copy(CHUNK):  pass
+    except OSError:
+        pass                        # the exec has ended, or won't read it
+    finally:
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+def receive_output(sock:socket.socket, stdout:int, stderr:int):
+    ' Copy the exec output frames from `sock` to `stdout` and `stderr`. '
+    src = sock.fileno()
+    copiers = { 1: Copier(src, stdout), 2: Copier(src, stderr) }
+    while (header := recv_exactly(sock, 8)):
+        kind, size = struct.unpack('>BxxxL', header)
+        copy = copiers.get(kind, copiers[1])
+        while size:
+            n = copy(min(size, CHUNK))
+            if n == 0:
+                return              # connection closed mid-frame
+            size -= n
+
+def recv_exactly(sock:socket.socket, size:int) -> bytes:
+    ' Receive `size` bytes, or fewer if the connection is closed first. '
+    data = b''
+    while len(data) < size:
+        got = sock.recv(size - len(data))
+        if not got:  break
+        data += got
+    return data
+
+def is_kind(fd:int, kind) -> bool:
+    try:
+        return kind(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+class Copier:
+    ''' A function copying up to `n` bytes from file descriptor `src` to
+        `dst` with the fewest copies the kernel allows, returning the number
+        copied, 0 at end of input.
+
+        `os.splice()` is used directly if either is a pipe, or else through
+        a pipe of our own; `os.sendfile()` from a regular file to a socket.
+        If the kernel won't do either for these files, the data is read and
+        written.
+    '''
+
+    def __init__(self, src:int, dst:int):
+        self.src, self.dst = src, dst
+        self.pipe:tuple[int,int]|None = None
+        self.method = 'read'
+        if is_kind(src, stat.S_ISREG) and is_kind(dst, stat.S_ISSOCK):
+            self.method = 'sendfile'
+        elif hasattr(os, 'splice'):
+            self.method = 'splice'
+            if not (is_kind(src, stat.S_ISFIFO) or is_kind(dst, stat.S_ISFIFO)):
+                self.pipe = os.pipe()
+
+    def __del__(self):
+        if self.pipe is not None:
+            for fd in self.pipe:  os.close(fd)
+
+    def __call__(self, n:int) -> int:
+        try:
+            if self.method == 'sendfile':
+                return os.sendfile(self.dst, self.src, None, n)
+            if self.method == 'splice':
+                if self.pipe is None:
+                    return os.splice(self.src, self.dst, n)
+                r, w = self.pipe
+                got = os.splice(self.src, w, n)
+                self.drain(got)
+                return got
+        except OSError as e:
+            if e.errno not in UNSPLICEABLE:  raise
+            self.method = 'read'
+        data = os.read(self.src, n)
+        self.write(data)
+        return len(data)
+
+    def drain(self, n:int):
+        ' Move the `n` bytes in our pipe to `dst`. '
+        assert self.pipe is not None
+        r, _ = self.pipe
+        try:
+            while n:
+                n -= os.splice(r, self.dst, n)
+        except OSError as e:
+            if e.errno not in UNSPLICEABLE:  raise
+            self.method = 'read'
+            while n:
+                data = os.read(r, n)
+                self.write(data)
+                n -= len(data)
+
+    def write(self, data:bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.dst, view):]
@@ -0,0 +1,179 @@
+''' dent.trace - timing of the phases of a Dent run and the commands it runs
+
+    When tracing is started (see `start()`) each `phase()` of the run,
+    each external command run via this module's `run()`, `call()` and
+    `check_output()` (or timed with `span()`), and each Docker Engine API
+    request is recorded with its start time and duration, from a monotonic
+    clock, relative to the start of the run. `finish()` prints these as a
+    summary on stderr (``--trace``) and/or appends them as a single JSON
+    record to a log file (``$DENT_TRACE_LOG``).
+
+    When not tracing, all this costs is a check of `TRACE`.
+'''
+
+from    collections.abc  import Iterator
+from    contextlib  import contextmanager
+from    pathlib  import Path
+from    subprocess  import PIPE, CalledProcessError, CompletedProcess
+from    typing  import Any
+import  os, subprocess, sys, threading, time
+
+from    dent.util  import PROGNAME, host_state
+
+class Trace:
+    ''' The records of a run started at `t0` on the monotonic clock. '''
+
+    def __init__(self, t0:float, summary:bool, log:Path|None):
+        self.t0 = t0
+        self.time = time.time() - (time.monotonic() - t0)   # Unix time of t0
+        self.summary = summary
+        self.log = log
+        self.records:list[dict[str,Any]] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()      # per-thread nesting depth
+
+    def begin(self, kind:str, name:str, **fields) -> dict[str,Any]:
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        rec = { 'kind': kind, 'name': name,
+                'start': time.monotonic() - self.t0, 'seconds': None,
+                'depth': depth, **fields }
+        if threading.current_thread() is not threading.main_thread():
+            rec['thread'] = threading.current_thread().name
+        with self.lock:
+            self.records.append(rec)
+        return rec
+
+    def end(self, rec:dict[str,Any]):
+        rec['seconds'] = time.monotonic() - self.t0 - rec['start']
+        self.local.depth -= 1
+
+TRACE:Trace|None = None
+
+def log_path(environ=None) -> Path|None:
+    ''' The file to which `finish()` appends the trace record: the path
+        in ``$DENT_TRACE_LOG`` if that's absolute, otherwise (if it's set
+        and not empty) ``trace.jsonl`` in Dent's host state dir.
+    '''
+    if environ is None:  environ = os.environ
+    log = environ.get('DENT_TRACE_LOG')
+    if not log:  return None
+    if log.startswith('/'):  return Path(log)
+    return host_state() / 'trace.jsonl'
+
+def start(t0:float, summary:bool):
+    ''' Start tracing a run that began at monotonic time `t0` if a
+        `summary` is wanted or `log_path()` gives a log. The time up to
+        now is recorded as the ``parseargs`` phase.
+    '''
+    global TRACE
+    log = log_path()
+    if not (summary or log):  return
+    TRACE = Trace(t0, summary, log)
+    rec = TRACE.begin('phase', 'parseargs')
+    rec['start'] = 0.0
+    TRACE.end(rec)
+
+@contextmanager
+def span(kind:str, name:str, **fields) -> Iterator[dict[str,Any]]:
+    ''' Time the body as a record of type `kind` (``phase``, ``command``,
+        ``request``) named `name`. The body may add fields to the yielded
+        record; in particular, ``status`` is shown in the summary.
+    '''
+    if TRACE is None:
+        yield {}
+        return
+    trace = TRACE
+    rec = trace.begin(kind, name, **fields)
+    try:
+        yield rec
+    finally:
+        trace.end(rec)
+
+def phase(name:str):
+    ''' Time the body as phase `name` of the run. As with any context
+        manager from `contextmanager`, this may also decorate a function.
+    '''
+    return span('phase', name)
+
+def command_span(command) -> Any:
+    ' A `span()` for running external `command` (a sequence of args). '
+    return span('command', ' '.join(command), argv=list(command))
+
+def run(command, **kwargs) -> CompletedProcess:
+    ' `subprocess.run()`, traced. '
+    with command_span(command) as rec:
+        try:
+            proc = subprocess.run(command, **kwargs)
+        except CalledProcessError as e:
+            rec['status'] = e.returncode
+            raise
+        rec['status'] = proc.returncode
+    return proc
+
+def call(command, **kwargs) -> int:
+    ' `subprocess.call()`, traced. '
+    return run(command, **kwargs).returncode
+
+def check_output(command, **kwargs) -> Any:
+    ' `subprocess.check_output()`, traced. '
+    return run(command, stdout=PIPE, check=True, **kwargs).stdout
+
+def finish(status:Any=None, exec:list[str]|None=None):
+    ''' Stop tracing, printing the summary and/or writing the log record.
+        `status` is our exit status or, when we're about to replace this
+        process with another command, `exec` is that command.
+    '''
+    global TRACE
+    if TRACE is None:  return
+    trace, TRACE = TRACE, None
+    if exec is not None:
+        #   Which, replacing this process, never ends as far as we know.
+        trace.begin('exec', ' '.join(exec), argv=exec)
+        trace.local.depth -= 1
+    total = time.monotonic() - trace.t0
+    if trace.summary:
+        print(summary(trace, total, status), file=sys.stderr, flush=True)
+    if trace.log:
+        write_log(trace, total, status, exec)
+
+def summary(trace:Trace, total:float, status:Any) -> str:
+    lines = [ '{}: trace: {:.4f}s{}'.format(PROGNAME, total,
+        '' if status is None else f', exit status {status}'),
+        '   start  seconds' ]
+    for r in trace.records:
+        seconds = '       -' if r['seconds'] is None \
+            else '{:8.4f}'.format(r['seconds'])
+        lines.append('{:8.4f} {}  {}{}{}{}'.format(r['start'], seconds,
+            '  ' * r['depth'], r['name'],
+            '' if r.get('status') is None else f'  [{r["status"]}]',
+            '' if 'thread' not in r else f'  ({r["thread"]})'))
+    return '\n'.join(lines)
+
+def write_log(trace:Trace, total:float, status:Any, exec:list[str]|None):
+    ''' Append the trace as one line of JSON to the log file. This is
+        best-effort: we never fail a run because we couldn't log it.
+    '''
+    import  json
+    record = {
+        'time':     round(trace.time, 6),
+        'pid':      os.getpid(),
+        'argv':     sys.argv,
+        'seconds':  total,
+        'status':   status if isinstance(status, int) else None,
+        'exec':     exec is not None,
+        'records':  trace.records,
+    }
+    assert trace.log is not None
+    try:
+        trace.log.parent.mkdir(parents=True, exist_ok=True)
+        #   A single write to a file opened for append, so concurrent runs
+        #   don't interleave their records.
+        line = (json.dumps(record) + '\n').encode('UTF-8')
+        fd = os.open(trace.log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
@@ -1,5 +1,6 @@
 ''' dent.util - constants and utility functions used throughout dent '''
 
+from    pathlib  import Path
 from    pwd import getpwuid
 from    sys import argv, stderr
 from    typing  import NoReturn
@@ -8,6 +9,22 @@ import  os
 PROGNAME    = os.path.basename(argv[0])
 PWENT       = getpwuid(os.getuid())
 
+#   Prefix of the names of the labels Dent puts on images and containers.
+LABEL_PREFIX = 'net.cynic.dent.'
+
+def state_home() -> Path:
+    ' The XDG state dir, ``${XDG_STATE_HOME:-$HOME/.local/state}``. '
+    return Path(os.environ.get('XDG_STATE_HOME')
+        or Path.home()/'.local'/'state')
+
+def host_state() -> Path:
+    ''' Dent's own host-side state (caches, logs, locks). This is in the
+        ``dent/`` dir holding the Dent shares (see `dent.container.dent_share`)
+        but, because container names cannot start with ``.``, cannot be
+        confused with a share.
+    '''
+    return state_home() / 'dent' / '.host'
+
 def qprint(quiet:bool, *args, force_print=False, **kwargs):
     ''' Call `print()` on arguments unless `quiet` is set.
 